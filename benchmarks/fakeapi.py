@@ -0,0 +1,416 @@
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+
+# A local stand-in for the Modrinth, Hangar, Paper and Geyser APIs. Responses
+# carry the fields mcpm's backends read (plus optional filler, to get realistic
+# payload sizes); jars are deterministic pseudo-random bytes.
+
+GAME_VERSION = '1.21.4'
+DEFAULT_VERSIONS = 3
+DEFAULT_JAR_SIZE = 256 * 1024
+DEFAULT_SERVER_JAR_SIZE = 48 * 1024 * 1024
+GEYSER_PROJECTS = [ 'geyser', 'floodgate' ]
+RATE_LIMITED = ( '/modrinth/', '/hangar/' )
+LIBRARIES = 8 # with dependencies on, pluginN requires libN%8, which requires corelib
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_size(value):
+    units = { 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+    value = str(value).strip().lower().removesuffix('b').removesuffix('i')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+class FakeApi:
+
+    def __init__(self, latency=0.0, bandwidth=None, jar_size=DEFAULT_JAR_SIZE,
+                 server_jar_size=DEFAULT_SERVER_JAR_SIZE, versions=DEFAULT_VERSIONS, padding=0,
+                 dependencies=False, rate_limit=None, rate_window=60):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jar_size = jar_size
+        self.server_jar_size = server_jar_size
+        self.versions = versions
+        self.padding = padding
+        self.dependencies = dependencies
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.base_url = None
+        self._releases = 0 # extra versions published on every project by release()
+        self._lock = threading.Lock()
+        self._files = {}
+        self._hashes = {}
+        self._requests = 0
+        self._bytes = 0
+        self._rejected = 0
+        self._window = (0.0, 0) # (start, requests), like modrinth: a fixed window per client
+        self._server = None
+
+    @property
+    def stats(self):
+        with self._lock:
+            return { 'requests': self._requests, 'bytes': self._bytes, 'rejected': self._rejected }
+
+    def reset_stats(self):
+        with self._lock:
+            self._requests = 0
+            self._bytes = 0
+            self._rejected = 0
+
+    def release(self):
+        with self._lock:
+            self._releases += 1
+
+    def env(self):
+        return {
+            'MCPM_MODRINTH_API_URL': f'{self.base_url}/modrinth/v2',
+            'MCPM_HANGAR_API_URL': f'{self.base_url}/hangar/v1',
+            'MCPM_PAPER_API_URL': f'{self.base_url}/paper/v3',
+            'MCPM_GEYSER_API_URL': f'{self.base_url}/geyser/v2',
+        }
+
+    def _count(self, n):
+        with self._lock:
+            self._requests += 1
+            self._bytes += n
+
+    def rate_limit_headers(self):
+        # None when the request is over the limit
+        now = time.monotonic()
+        with self._lock:
+            start, count = self._window
+            if now - start >= self.rate_window:
+                start, count = now, 0
+            reset = max(0, int(start + self.rate_window - now + 0.999))
+            headers = { 'X-Ratelimit-Limit': self.rate_limit, 'X-Ratelimit-Reset': reset }
+            if count >= self.rate_limit:
+                self._rejected += 1
+                return None, { **headers, 'X-Ratelimit-Remaining': 0, 'Retry-After': reset }
+            self._window = (start, count + 1)
+            return True, { **headers, 'X-Ratelimit-Remaining': self.rate_limit - count - 1 }
+
+    def _file(self, name, size):
+        # (bytes, sha1, sha256, sha512), generated on first use
+        with self._lock:
+            if name in self._files:
+                return self._files[name]
+        rng = random.Random(name)
+        data = rng.randbytes(max(1, int(size * rng.uniform(0.5, 1.5))))
+        entry = (data, hashlib.sha1(data).hexdigest(), hashlib.sha256(data).hexdigest(), hashlib.sha512(data).hexdigest())
+        with self._lock:
+            self._files[name] = entry
+            for digest in entry[1:]:
+                self._hashes[digest] = name
+        return entry
+
+    def _version_count(self):
+        with self._lock:
+            return self.versions + self._releases
+
+    def _filler(self):
+        return 'x' * self.padding
+
+    def _requires(self, slug):
+        if not self.dependencies:
+            return []
+        if slug.startswith('plugin') and slug[6:].isdigit():
+            return [ f'lib{int(slug[6:]) % LIBRARIES}' ]
+        if slug.startswith('lib'):
+            return [ 'corelib' ]
+        return []
+
+    # modrinth
+
+    def _modrinth_version(self, slug, n):
+        filename = f'{slug}-1.{n}.0.jar'
+        data, sha1, _, sha512 = self._file(filename, self.jar_size)
+        return {
+            'id': f'{slug}-v{n}',
+            'project_id': f'id-{slug}',
+            'version_number': f'1.{n}.0',
+            'version_type': 'release',
+            'loaders': [ 'paper', 'spigot' ],
+            'game_versions': [ GAME_VERSION ],
+            'date_published': f'2024-01-01T00:00:{n:02d}Z',
+            'changelog': self._filler(),
+            'dependencies': [
+                { 'project_id': f'id-{dependency}', 'version_id': None, 'dependency_type': 'required' }
+                for dependency in self._requires(slug)
+            ],
+            'files': [{
+                'url': f'{self.base_url}/files/{filename}',
+                'filename': filename,
+                'primary': True,
+                'size': len(data),
+                'hashes': { 'sha1': sha1, 'sha512': sha512 },
+            }],
+        }
+
+    def _modrinth_project(self, slug):
+        return {
+            'id': f'id-{slug}',
+            'slug': slug,
+            'description': self._filler(),
+            'versions': [ f'{slug}-v{n}' for n in range(self._version_count()) ],
+        }
+
+    def modrinth(self, method, parts, query, body):
+        slug_of = lambda name: name.removeprefix('id-')
+        if method == 'POST' and parts == [ 'version_files', 'update' ]:
+            results = {}
+            for digest in body['hashes']:
+                name = self._hashes.get(digest)
+                if name is not None:
+                    slug = name.rsplit('-', 1)[0]
+                    results[digest] = self._modrinth_version(slug, self._version_count() - 1)
+            return 200, results
+        if parts == [ 'projects' ]:
+            return 200, [ self._modrinth_project(slug_of(name)) for name in json.loads(query['ids'][0]) ]
+        if parts == [ 'versions' ]:
+            versions = []
+            for version_id in json.loads(query['ids'][0]):
+                slug, _, n = version_id.rpartition('-v')
+                versions.append(self._modrinth_version(slug, int(n)))
+            return 200, versions
+        if len(parts) == 3 and parts[0] == 'project' and parts[2] == 'version':
+            slug = slug_of(parts[1])
+            return 200, [ self._modrinth_version(slug, n) for n in reversed(range(self._version_count())) ]
+        return 404, { 'error': 'not_found', 'description': 'the requested route does not exist' }
+
+    # hangar
+
+    def hangar(self, method, parts, query, body):
+        if len(parts) != 3 or parts[0] != 'projects' or parts[2] != 'versions':
+            return 404, { 'httpError': { 'statusCode': 404 }, 'message': 'Not found' }
+        slug = parts[1]
+        limit = int(query.get('limit', [ 25 ])[0])
+        offset = int(query.get('offset', [ 0 ])[0])
+        count = self._version_count()
+        results = []
+        for n in reversed(range(count)):
+            filename = f'{slug}-2.{n}.0.jar'
+            data, _, sha256, _ = self._file(filename, self.jar_size)
+            results.append({
+                'name': f'2.{n}.0',
+                'description': self._filler(),
+                'channel': { 'name': 'Release' },
+                'pluginDependencies': {
+                    'PAPER': [
+                        { 'name': dependency, 'required': True, 'externalUrl': None, 'platform': 'PAPER' }
+                        for dependency in self._requires(slug)
+                    ],
+                },
+                'downloads': {
+                    'PAPER': {
+                        'downloadUrl': f'{self.base_url}/files/{filename}',
+                        'fileInfo': { 'name': filename, 'sizeBytes': len(data), 'sha256Hash': sha256 },
+                    },
+                },
+            })
+        return 200, {
+            'pagination': { 'limit': limit, 'offset': offset, 'count': count },
+            'result': results[offset:offset + limit],
+        }
+
+    # paper
+
+    def _paper_build(self, project, game_version, n):
+        filename = f'{project}-{game_version}-{n}.jar'
+        data, _, sha256, _ = self._file(filename, self.server_jar_size)
+        return {
+            'id': n,
+            'channel': 'STABLE',
+            'commits': [ { 'message': self._filler() } ],
+            'downloads': {
+                'server:default': {
+                    'name': filename,
+                    'size': len(data),
+                    'checksums': { 'sha256': sha256 },
+                    'url': f'{self.base_url}/files/{filename}',
+                },
+            },
+        }
+
+    def paper(self, method, parts, query, body):
+        build_ids = list(reversed(range(100, 100 + self._version_count())))
+        if len(parts) == 3 and parts[0] == 'projects' and parts[2] == 'versions':
+            return 200, { 'versions': [ { 'version': { 'id': GAME_VERSION }, 'builds': build_ids } ] }
+        if len(parts) == 5 and parts[0] == 'projects' and parts[4] == 'builds':
+            project, game_version = parts[1], parts[3]
+            return 200, [ self._paper_build(project, game_version, n) for n in build_ids ]
+        if len(parts) == 6 and parts[0] == 'projects' and parts[4] == 'builds' and parts[5].isdigit() \
+                and int(parts[5]) in build_ids:
+            return 200, self._paper_build(parts[1], parts[3], int(parts[5]))
+        return 404, { 'error': 'not_found', 'message': 'Not found' }
+
+    # geyser
+
+    def geyser(self, method, parts, query, body):
+        if len(parts) < 2 or parts[0] != 'projects' or parts[1] not in GEYSER_PROJECTS:
+            return 404, { 'error': 'Not found' }
+        project = parts[1]
+        count = self._version_count()
+        if len(parts) == 2:
+            return 200, { 'project_id': project, 'versions': [ '2.6.0' ] }
+        if len(parts) == 4:
+            return 200, { 'project_id': project, 'version': parts[3], 'builds': list(range(700, 700 + count)) }
+        if len(parts) == 6:
+            version, build = parts[3], parts[5]
+            if version == 'latest':
+                version = '2.6.0'
+            if build == 'latest':
+                build = str(700 + count - 1)
+            downloads = {}
+            for platform in [ 'spigot', 'velocity', 'bungeecord' ]:
+                filename = f'{project}-{platform}-{build}.jar'
+                _, _, sha256, _ = self._file(filename, self.jar_size)
+                downloads[platform] = { 'name': filename, 'sha256': sha256 }
+            return 200, {
+                'project_id': project,
+                'version': version,
+                'build': int(build),
+                'changes': self._filler(),
+                'downloads': downloads,
+            }
+        if len(parts) == 8 and parts[6] == 'downloads':
+            return 'file', f'{project}-{parts[7]}-{parts[5]}.jar'
+        return 404, { 'error': 'Not found' }
+
+    def control(self, method, parts):
+        if parts == [ 'stats' ]:
+            return 200, self.stats
+        if method == 'POST' and parts == [ 'reset' ]:
+            self.reset_stats()
+            return 200, {}
+        if method == 'POST' and parts == [ 'release' ]:
+            self.release()
+            return 200, {}
+        return 404, {}
+
+    def route(self, method, path, body):
+        url = urllib.parse.urlsplit(path)
+        parts = [ urllib.parse.unquote(part) for part in url.path.strip('/').split('/') ]
+        query = urllib.parse.parse_qs(url.query)
+        if parts[0] == 'files' and len(parts) == 2:
+            return 'file', parts[1]
+        if parts[0] == '_control':
+            return self.control(method, parts[1:])
+        apis = {
+            'modrinth': self.modrinth,
+            'hangar': self.hangar,
+            'paper': self.paper,
+            'geyser': self.geyser,
+        }
+        if parts[0] not in apis or len(parts) < 2:
+            return 404, {}
+        return apis[parts[0]](method, parts[2:], query, body)
+
+    def start(self, host='127.0.0.1', port=0):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _write(self, data):
+                if api.bandwidth is None:
+                    self.wfile.write(data)
+                    return
+                for i in range(0, len(data), CHUNK_SIZE):
+                    chunk = data[i:i + CHUNK_SIZE]
+                    self.wfile.write(chunk)
+                    time.sleep(len(chunk) / api.bandwidth)
+
+            def _handle(self, method):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length)) if length else None
+                if api.latency:
+                    time.sleep(api.latency)
+                allowed, headers = True, {}
+                if api.rate_limit and self.path.startswith(RATE_LIMITED):
+                    allowed, headers = api.rate_limit_headers()
+                if allowed:
+                    status, payload = api.route(method, self.path, body)
+                else:
+                    status, payload = 429, { 'error': 'ratelimited' }
+                if status == 'file':
+                    entry = api._files.get(payload)
+                    status, data, kind = (200, entry[0], 'application/java-archive') if entry else (404, b'', 'text/plain')
+                else:
+                    data, kind = json.dumps(payload).encode(), 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, str(value))
+                self.end_headers()
+                self._write(data)
+                if not self.path.startswith('/_control/'):
+                    api._count(len(data))
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def log_message(self, *args):
+                pass
+
+        http.server.ThreadingHTTPServer.daemon_threads = True
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.base_url = f'http://{host}:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve fake Modrinth/Hangar/Paper/Geyser APIs')
+    parser.add_argument('--port', type=int, default=8765, help='0 picks a free port')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=parse_size, help='bytes per second per connection, e.g. 10M')
+    parser.add_argument('--jar-size', type=parse_size, default=DEFAULT_JAR_SIZE, help='average plugin jar size')
+    parser.add_argument('--server-jar-size', type=parse_size, default=DEFAULT_SERVER_JAR_SIZE)
+    parser.add_argument('--versions', type=int, default=DEFAULT_VERSIONS,
+                        help='versions published per project at startup')
+    parser.add_argument('--padding', type=parse_size, default=0,
+                        help='filler bytes in every metadata object (changelogs, descriptions)')
+    parser.add_argument('--dependencies', action='store_true',
+                        help=f'pluginN requires libN%%{LIBRARIES}, which requires corelib')
+    parser.add_argument('--rate-limit', type=int,
+                        help='requests per window to the modrinth and hangar apis, 429 past that')
+    parser.add_argument('--rate-window', type=float, default=60, help='rate limit window in seconds')
+    args = parser.parse_args()
+    api = FakeApi(
+            args.latency, args.bandwidth, args.jar_size, args.server_jar_size,
+            args.versions, args.padding, args.dependencies, args.rate_limit, args.rate_window
+        )
+    api.start(port=args.port)
+    # GET /_control/stats, POST /_control/reset and POST /_control/release drive the server remotely
+    print(f'# listening on {api.base_url}')
+    for name, value in api.env().items():
+        print(f'export {name}={value}')
+    sys.stdout.flush()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
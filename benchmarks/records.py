@@ -0,0 +1,64 @@
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import mcpm.common as common
+import mcpm.config as config
+
+
+# Times the in-memory lockfile bookkeeping (config parsing, lookups, merging
+# newly resolved plugins, serialization) for workspaces with thousands of
+# plugins. The time per plugin should stay flat as the workspace grows.
+#
+#   python benchmarks/records.py --plugins 1000 2000 4000 8000 16000
+
+DEFAULT_PLUGINS = [ 1000, 2000, 4000, 8000, 16000 ]
+REPEAT = 3
+
+
+def make_version(name):
+    downloads = [ common.DownloadRecord(f'https://example.com/{name}.jar', f'{name}.jar', { 'sha512': '0' * 128 }, 1024) ]
+    return common.VersionRecord(name, 'modrinth', '1.0.0', 'release', downloads)
+
+
+def run_once(n):
+    names = [ f'hangar/plugin{i}' if i % 10 == 9 else f'plugin{i}' for i in range(n) ]
+    cfg = config.McpmConfig(pathlib.Path('.'), { 'server': { 'plugins': names } })
+    # half the plugins are locked already, the other half were just resolved
+    plugins = list(cfg.plugins)
+    locked = [ make_version(plugin.name) for plugin in plugins[::2] ]
+    resolved = [ make_version(plugin.name) for plugin in plugins[1::2] ]
+    lock = common.LockRecord('paper', '1.21.4', make_version('paper'), locked)
+
+    start = time.perf_counter()
+    pending = config.pending_plugins(cfg, lock)
+    assert len(pending) == len(resolved)
+    config.finish_lock(cfg, lock, resolved)
+    for name in names:
+        assert cfg.find_plugin(name) is not None
+    for plugin in cfg.plugins:
+        lock.replace_plugin(lock.find_plugin(plugin.name), make_version(plugin.name))
+    data = json.dumps(lock.to_dict())
+    lock = common.LockRecord.from_dict(json.loads(data))
+    assert config.is_lock_current(cfg, lock)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark lockfile bookkeeping for large workspaces')
+    parser.add_argument('--plugins', type=int, nargs='+', default=DEFAULT_PLUGINS,
+                        help=f'workspace sizes to run (default: {" ".join(map(str, DEFAULT_PLUGINS))})')
+    args = parser.parse_args()
+
+    print(f"{'plugins':>8} {'time':>9} {'per plugin':>11}")
+    for n in args.plugins:
+        elapsed = min(run_once(n) for _ in range(REPEAT))
+        print(f'{n:>8} {elapsed * 1000:>7.1f}ms {elapsed / n * 1e6:>9.2f}us')
+
+
+if __name__ == '__main__':
+    main()
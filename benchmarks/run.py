@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import fakeapi
+
+
+# Runs the mcpm cli against the fake APIs for workspaces of increasing size
+# and reports wall time, requests, bytes transferred and peak RSS per command.
+#
+#   python benchmarks/run.py --plugins 5 50 500 --latency 0.05 --bandwidth 20M
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+DEFAULT_PLUGINS = [ 5, 50, 500 ]
+HANGAR_EVERY = 10 # every nth plugin comes from hangar, the rest from modrinth
+
+# (label, mcpm arguments, publish new versions first)
+STEPS = [
+    ('lock', [ 'lock' ], False),
+    ('provision', [ 'provision' ], False),
+    ('relock', [ 'lock' ], False),
+    ('upgrade', [ 'upgrade' ], True),
+    ('reprovision', [ 'provision' ], False),
+]
+
+
+def make_workspace(dir, n):
+    plugins = [ 'geyser/geyser' ] if n > 1 else []
+    for i in range(n - len(plugins)):
+        plugins.append(f'hangar/plugin{i}' if i % HANGAR_EVERY == HANGAR_EVERY - 1 else f'plugin{i}')
+    lines = [ '[server]', 'loader = "paper"', 'version = "latest"', 'plugins = [' ]
+    lines += [ f'    "{plugin}",' for plugin in plugins ]
+    lines += [ ']' ]
+    (dir / 'mcpm.toml').write_text('\n'.join(lines) + '\n')
+
+
+def run_mcpm(args, cwd, env):
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+            [ sys.executable, '-m', 'mcpm' ] + args, cwd=cwd, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+    stderr = proc.stderr.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"mcpm {' '.join(args)} failed:\n{stderr.decode(errors='replace')}")
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return elapsed, rss
+
+
+class FakeApiProcess:
+    # the fake apis run in their own process so that generated jars don't count
+    # towards mcpm's peak rss (children inherit the parent's high-water mark)
+
+    def __init__(self, args):
+        self._proc = subprocess.Popen(
+                [ sys.executable, str(pathlib.Path(__file__).with_name('fakeapi.py')), '--port', '0' ] + args,
+                stdout=subprocess.PIPE, text=True
+            )
+        self.base_url = self._proc.stdout.readline().split()[-1]
+        self._env = {}
+        for _ in range(4):
+            name, _, value = self._proc.stdout.readline().removeprefix('export ').strip().partition('=')
+            self._env[name] = value
+
+    def env(self):
+        return dict(self._env)
+
+    def _call(self, action, method='POST'):
+        data = b'' if method == 'POST' else None
+        request = urllib.request.Request(f'{self.base_url}/_control/{action}', data=data, method=method)
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+
+    @property
+    def stats(self):
+        return self._call('stats', 'GET')
+
+    def reset_stats(self):
+        self._call('reset')
+
+    def release(self):
+        self._call('release')
+
+    def stop(self):
+        self._proc.terminate()
+        self._proc.wait()
+
+
+def run_workspace(api, n, jobs):
+    results = []
+    with tempfile.TemporaryDirectory(prefix='mcpm-bench-') as tmp:
+        tmp = pathlib.Path(tmp)
+        workspace = tmp / 'workspace'
+        workspace.mkdir()
+        make_workspace(workspace, n)
+        env = dict(os.environ)
+        env.update(api.env())
+        env['MCPM_CACHE_DIR'] = str(tmp / 'cache') # every size starts cold
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ str(ROOT_DIR), env.get('PYTHONPATH') ]))
+        for label, args, release in STEPS:
+            if release:
+                api.release()
+            api.reset_stats()
+            elapsed, rss = run_mcpm([ '-j', str(jobs) ] + args, workspace, env)
+            stats = api.stats
+            results.append({
+                'plugins': n,
+                'step': label,
+                'seconds': round(elapsed, 3),
+                'requests': stats['requests'],
+                'bytes': stats['bytes'],
+                'peak_rss': rss,
+            })
+    return results
+
+
+def format_size(n):
+    for unit in [ 'B', 'KiB', 'MiB' ]:
+        if n < 1024:
+            return f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} GiB'
+
+
+def print_table(results):
+    print(f"{'plugins':>8} {'step':<12} {'wall':>9} {'requests':>9} {'transferred':>12} {'peak rss':>10}")
+    for row in results:
+        print(
+            f"{row['plugins']:>8} {row['step']:<12} {row['seconds']:>8.2f}s {row['requests']:>9}"
+            f" {format_size(row['bytes']):>12} {format_size(row['peak_rss']):>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark mcpm against local fake APIs')
+    parser.add_argument('--plugins', type=int, nargs='+', default=DEFAULT_PLUGINS,
+                        help=f'workspace sizes to run (default: {" ".join(map(str, DEFAULT_PLUGINS))})')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='passed through to mcpm -j')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=fakeapi.parse_size, help='bytes per second per connection, e.g. 10M')
+    parser.add_argument('--jar-size', type=fakeapi.parse_size, default=fakeapi.DEFAULT_JAR_SIZE,
+                        help='average plugin jar size')
+    parser.add_argument('--server-jar-size', type=fakeapi.parse_size, default=fakeapi.DEFAULT_SERVER_JAR_SIZE)
+    parser.add_argument('--versions', type=int, default=fakeapi.DEFAULT_VERSIONS,
+                        help='versions published per project before the run')
+    parser.add_argument('--padding', type=fakeapi.parse_size, default=0,
+                        help='filler bytes in every metadata object (changelogs, descriptions)')
+    parser.add_argument('--dependencies', action='store_true',
+                        help='give plugins a shared tree of required library dependencies')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    results = []
+    for n in args.plugins:
+        # a fresh server per size, so every size sees the same catalog
+        api = FakeApiProcess([
+                '--latency', str(args.latency), '--jar-size', str(args.jar_size),
+                '--server-jar-size', str(args.server_jar_size), '--versions', str(args.versions),
+                '--padding', str(args.padding),
+            ] + ([ '--bandwidth', str(args.bandwidth) ] if args.bandwidth else [])
+              + ([ '--dependencies' ] if args.dependencies else []))
+        try:
+            results += run_workspace(api, n, args.jobs)
+        finally:
+            api.stop()
+        if not args.json:
+            print_table([ row for row in results if row['plugins'] == n ])
+            print()
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
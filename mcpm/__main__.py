@@ -1,4 +1,4 @@
-import cli
+import mcpm.cli as cli
 import sys
 
 sys.exit(cli.main())
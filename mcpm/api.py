@@ -1,59 +1,207 @@
+import asyncio
 import mcpm.modrinth as modrinth
 import mcpm.hangar as hangar
 import mcpm.geyser as geyser
 import mcpm.paper as paper
 import mcpm.common as common
+import mcpm.trace as trace
 
 
-def iter_plugin_versions(name, source, channel, loader, game_version):
-    backends = {
-        'modrinth': modrinth,
-        'hangar': hangar,
-        'geyser': geyser,
-    }
+# Backends are modules. A backend may implement the async protocol
+# (aiter_plugin_versions / aiter_server_versions / aget_latest_version /
+# aresolve_plugins) natively; any coroutine it does not provide is derived
+# from its blocking counterpart and run on the event loop's executor.
+
+PLUGIN_BACKENDS = {
+    'modrinth': modrinth,
+    'hangar': hangar,
+    'geyser': geyser,
+}
+
+SERVER_BACKENDS = {
+    'paper': paper,
+    'folia': paper,
+    'travertine': paper,
+    'velocity': paper,
+    'waterfall': paper,
+}
+
+
+async def _aiter_blocking(iterator):
+    done = object()
+    while (item := await common.to_thread(next, iterator, done)) is not done:
+        yield item
+
+
+def _get_plugin_backend(source, channel):
     if source is None:
         source = 'modrinth'
+    backend = PLUGIN_BACKENDS[source]
     if channel is None:
-        channel = backends[source].get_default_channel()
-    yield from backends[source].iter_plugin_versions(name, loader, game_version, channel)
+        channel = backend.get_default_channel()
+    return backend, channel
+
+
+def iter_plugin_versions(name, source, channel, loader, game_version):
+    backend, channel = _get_plugin_backend(source, channel)
+    yield from backend.iter_plugin_versions(name, loader, game_version, channel)
+
+
+async def aiter_plugin_versions(name, source, channel, loader, game_version):
+    backend, channel = _get_plugin_backend(source, channel)
+    if hasattr(backend, 'aiter_plugin_versions'):
+        versions = backend.aiter_plugin_versions(name, loader, game_version, channel)
+    else:
+        versions = _aiter_blocking(backend.iter_plugin_versions(name, loader, game_version, channel))
+    async for version in versions:
+        yield version
+
+
+def _plugin_unavailable(name, loader, game_version):
+    msg = f'Plugin {name} is not available for Minecraft {game_version} on {loader}.'
+    return common.McpmError(msg)
 
 
 def get_plugin_version(name, source, channel, loader, game_version):
     try:
         return next(iter_plugin_versions(name, source, channel, loader, game_version))
     except StopIteration:
-        msg = f'Plugin {name} is not available for Minecraft {game_version} on {loader}.'
-        raise common.McpmError(msg)
+        raise _plugin_unavailable(name, loader, game_version)
+
+
+async def aget_plugin_version(name, source, channel, loader, game_version):
+    versions = aiter_plugin_versions(name, source, channel, loader, game_version)
+    try:
+        async for version in versions:
+            return version
+    finally:
+        await versions.aclose()
+    raise _plugin_unavailable(name, loader, game_version)
+
+
+async def _aresolve_batch(backend, batch, loader, game_version):
+    if hasattr(backend, 'aresolve_plugins'):
+        return await backend.aresolve_plugins(batch, loader, game_version)
+    return await common.to_thread(backend.resolve_plugins, batch, loader, game_version)
+
+
+async def _aresolve_source_batch(source, indices, queries, loader, game_version, current, results):
+    backend = PLUGIN_BACKENDS[source]
+    if len(indices) < 2:
+        return
+    if not hasattr(backend, 'resolve_plugins') and not hasattr(backend, 'aresolve_plugins'):
+        return
+    batch = [
+        (queries[i][0], queries[i][2] or backend.get_default_channel(), current[i])
+        for i in indices
+    ]
+    try:
+        with trace.async_span(f'{source} batch', 'batch', plugins=len(batch)) as span:
+            resolved = await _aresolve_batch(backend, batch, loader, game_version)
+            span.set(resolved=len(resolved))
+    except (common.ApiError, OSError, ValueError, KeyError):
+        return # anything the batch could not answer is resolved one by one
+    for j, version in resolved.items():
+        results[indices[j]] = version
+
+
+async def aresolve_plugins(queries, loader, game_version, workers=None, current=None,
+                           return_exceptions=False):
+    if workers is None:
+        workers = common.DEFAULT_WORKERS
+    queries = list(queries)
+    if current is None:
+        current = [ None ] * len(queries)
+    results = [ None ] * len(queries)
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def resolve(i):
+        name, source, channel = queries[i]
+        async with semaphore:
+            with trace.async_span(name, 'resolve', source=source or 'modrinth'):
+                try:
+                    results[i] = await aget_plugin_version(name, source, channel, loader, game_version)
+                except Exception as e:
+                    results[i] = e
+
+    async def resolve_source(source, indices):
+        # each source's batch only holds up that source, the others resolve meanwhile
+        await _aresolve_source_batch(source, indices, queries, loader, game_version, current, results)
+        await asyncio.gather(*(resolve(i) for i in indices if results[i] is None))
+
+    by_source = {}
+    for i, (name, source, channel) in enumerate(queries):
+        by_source.setdefault(source or 'modrinth', []).append(i)
+    await asyncio.gather(*(resolve_source(source, indices) for source, indices in by_source.items()))
+    errors = [ (queries[i][0], version) for i, version in enumerate(results) if isinstance(version, Exception) ]
+    if errors and not return_exceptions:
+        raise common.ResolutionError(errors)
+    return results
+
+
+async def aget_project_names(source, refs):
+    backend = PLUGIN_BACKENDS[source]
+    if not hasattr(backend, 'get_project_names'):
+        return { ref: ref for ref in refs }
+    names = await common.to_thread(backend.get_project_names, sorted(refs))
+    return { ref: names.get(ref, ref) for ref in refs }
+
+
+def resolve_plugins(queries, loader, game_version, workers=None, current=None):
+    return common.run(aresolve_plugins(queries, loader, game_version, workers, current), workers)
 
 
 def iter_server_versions(server_name, game_version):
-    backends = {
-        'paper': paper,
-        'folia': paper,
-        'travertine': paper,
-        'velocity': paper,
-        'waterfall': paper,
-    }
-    yield from backends[server_name].iter_server_versions(server_name, game_version)
+    yield from SERVER_BACKENDS[server_name].iter_server_versions(server_name, game_version)
+
+
+async def aiter_server_versions(server_name, game_version):
+    backend = SERVER_BACKENDS[server_name]
+    if hasattr(backend, 'aiter_server_versions'):
+        versions = backend.aiter_server_versions(server_name, game_version)
+    else:
+        versions = _aiter_blocking(backend.iter_server_versions(server_name, game_version))
+    async for version in versions:
+        yield version
 
 
 def get_latest_game_version(server_name):
-    backends = {
-        'paper': paper,
-        'folia': paper,
-        'travertine': paper,
-        'velocity': paper,
-        'waterfall': paper,
-    }
-    return backends[server_name].get_latest_version(server_name)
+    return SERVER_BACKENDS[server_name].get_latest_version(server_name)
+
+
+async def aget_latest_game_version(server_name):
+    backend = SERVER_BACKENDS[server_name]
+    if hasattr(backend, 'aget_latest_version'):
+        return await backend.aget_latest_version(server_name)
+    return await common.to_thread(backend.get_latest_version, server_name)
+
+
+def list_server_versions(server_name):
+    if server_name not in SERVER_BACKENDS:
+        raise common.McpmError(f'Unknown server {server_name}.')
+    return SERVER_BACKENDS[server_name].list_versions(server_name)
+
+
+def _server_unavailable(server_name, game_version):
+    msg = f'Server {server_name} is not available for Minecraft {game_version}.'
+    return common.McpmError(msg)
 
 
 def get_server_version(server_name, game_version):
     try:
         return next(iter_server_versions(server_name, game_version))
     except StopIteration:
-        msg = f'Server {server_name} is not available for Minecraft {game_version}.'
-        raise common.McpmError(msg)
+        raise _server_unavailable(server_name, game_version)
+
+
+async def aget_server_version(server_name, game_version):
+    versions = aiter_server_versions(server_name, game_version)
+    try:
+        async for version in versions:
+            return version
+    finally:
+        await versions.aclose()
+    raise _server_unavailable(server_name, game_version)
 
 
 def upgrade_server(lock):
@@ -62,18 +210,67 @@ def upgrade_server(lock):
     lock.server = new_ver
 
 
+def _find_locked_plugin(lock, plugin):
+    ver = lock.find_plugin(plugin)
+    if ver is None:
+        raise common.McpmError(f'Plugin {plugin} is not in mcpm.lock.')
+    return ver
+
+
+async def aupgrade_plugins(lock, *plugins, workers=None):
+    if len(plugins):
+        old_vers = [ _find_locked_plugin(lock, plugin) for plugin in plugins ]
+    else:
+        old_vers = list(lock.plugins)
+    new_vers = await aresolve_plugins(
+            [ (ver.name, ver.source, ver.channel) for ver in old_vers ],
+            lock.loader, lock.game_version, workers, current=old_vers
+        )
+    for old_ver, new_ver in zip(old_vers, new_vers):
+        lock.replace_plugin(old_ver, new_ver)
+
+
 def upgrade_plugin(lock, plugin):
-    old_ver = lock.find_plugin(plugin)
-    new_ver = get_plugin_version(
-            old_ver.name, old_ver.source, old_ver.channel,
-            lock.loader, lock.game_version
+    upgrade_plugins(lock, plugin, workers=1)
+
+
+def upgrade_plugins(lock, *plugins, workers=None):
+    common.run(aupgrade_plugins(lock, *plugins, workers=workers), workers)
+
+
+def outdated_entry(locked, latest):
+    entry = {
+        'name': locked.name,
+        'source': locked.source,
+        'current': locked.version,
+        'latest': None,
+    }
+    if isinstance(latest, Exception):
+        entry['error'] = str(latest) or type(latest).__name__
+    else:
+        entry['latest'] = latest.version
+    entry['outdated'] = entry['latest'] is not None and entry['latest'] != entry['current']
+    return entry
+
+
+async def aoutdated(lock, workers=None):
+    # compares without touching the lock: one entry for the server, then one per plugin
+    plugins = list(lock.plugins)
+    server, plugin_versions = await asyncio.gather(
+            aget_server_version(lock.loader, lock.game_version),
+            aresolve_plugins(
+                [ (ver.name, ver.source, ver.channel) for ver in plugins ],
+                lock.loader, lock.game_version, workers, current=plugins, return_exceptions=True
+            ),
+            return_exceptions=True
         )
-    lock.plugins.remove(old_ver)
-    lock.plugins.append(new_ver)
+    if isinstance(plugin_versions, BaseException):
+        raise plugin_versions
+    pairs = list(zip(plugins, plugin_versions))
+    if lock.server is not None:
+        pairs.insert(0, (lock.server, server))
+    return [ outdated_entry(locked, latest) for locked, latest in pairs ]
 
 
-def upgrade_plugins(lock, *plugins):
-    if not len(plugins):
-        plugins = [ plugin.name for plugin in lock.plugins ]
-    for plugin in plugins:
-        upgrade_plugin(lock, plugin)
+def outdated(lock, workers=None):
+    return common.run(aoutdated(lock, workers), workers)
@@ -0,0 +1,179 @@
+import io
+import json
+import os
+import pathlib
+import tarfile
+import tempfile
+import threading
+import time
+import mcpm.common as common
+import mcpm.manifest as manifest
+import mcpm.provision as provision
+import mcpm.store as store
+import mcpm.trace as trace
+
+
+BUNDLE_VERSION = 1
+DEFAULT_BUNDLE_NAME = 'mcpm-bundle.tar'
+INDEX_NAME = 'mcpm-bundle.json'
+
+
+def _member_name(download):
+    key = store.ArtifactStore.key(download.checksums)
+    if key is None:
+        return f'artifacts/{download.filename}'
+    algo, digest = key
+    return f'artifacts/{algo}/{digest}'
+
+
+def _copy_range(fd_src, fd_dest, offset, size):
+    end = offset + size
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                n = os.copy_file_range(fd_src, fd_dest, end - offset, offset_src=offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            pass # not supported between these files, finish with plain reads
+    while offset < end:
+        chunk = os.pread(fd_src, min(provision.CHUNK_SIZE, end - offset), offset)
+        if not chunk:
+            raise common.McpmError('The bundle is truncated.')
+        offset += len(chunk)
+        while chunk:
+            chunk = chunk[os.write(fd_dest, chunk):]
+
+
+class Bundle:
+
+    def __init__(self, path):
+        self._path = path
+        self._members = {}
+        index = None
+        try:
+            # uncompressed only, artifacts are copied straight out of the archive by offset
+            with tarfile.open(path, 'r:') as tar:
+                for member in tar:
+                    if member.name == INDEX_NAME:
+                        index = json.load(tar.extractfile(member))
+                    elif member.isfile():
+                        self._members[member.name] = (member.offset_data, member.size)
+        except (OSError, tarfile.TarError, ValueError) as e:
+            raise common.McpmError(f'Could not read the bundle {path}: {e}')
+        if index is None or index.get('version') != BUNDLE_VERSION:
+            raise common.McpmError(f'{path} is not an mcpm bundle.')
+        self._index = index
+        self._fd = os.open(path, os.O_RDONLY)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def index(self):
+        return self._index
+
+    def extract(self, download, dest, progress=None, readonly=False):
+        name = _member_name(download)
+        if name not in self._members:
+            raise common.McpmError(f'{download.filename} is not in the bundle {self._path}.')
+        offset, size = self._members[name]
+        tmp = dest.with_name(f'.{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with trace.span(download.filename, 'extract', bytes=size), open(tmp, 'wb') as f:
+                _copy_range(self._fd, f.fileno(), offset, size)
+            provision.check_file(tmp, download.checksums, download.filename)
+            store.move_into_place(tmp, dest, readonly)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        if progress is not None:
+            progress.add_bytes(size)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _write_bundle(lock, sources, path):
+    artifacts = [
+        {
+            'name': name,
+            'filename': download.filename,
+            'checksums': download.checksums,
+            'size': src.stat().st_size,
+        }
+        for name, (download, src) in sorted(sources.items())
+    ]
+    index = {
+        'version': BUNDLE_VERSION,
+        'loader': lock.loader,
+        'game_version': lock.game_version,
+        'artifacts': artifacts,
+    }
+    data = json.dumps(index, indent=2).encode()
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with tarfile.open(tmp, 'w', format=tarfile.PAX_FORMAT) as tar:
+            info = tarfile.TarInfo(INDEX_NAME)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+            for artifact in artifacts:
+                tar.add(sources[artifact['name']][1], arcname=artifact['name'])
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return index
+
+
+async def aexport_bundle(lock, root_dir, path, workers=None, host_workers=provision.DEFAULT_HOST_WORKERS,
+                         artifact_store=None):
+    if workers is None:
+        workers = common.DEFAULT_WORKERS
+    jobs = [ (lock.server, root_dir) ] + [ (plugin, root_dir / 'plugins') for plugin in lock.plugins ]
+    state = manifest.get_manifest(root_dir)
+    sources = {}
+    missing = {}
+    for pkg_lock, dir in jobs:
+        for download in pkg_lock.downloads:
+            name = _member_name(download)
+            if name in sources or name in missing:
+                continue
+            if artifact_store is not None and artifact_store.has(download.checksums):
+                sources[name] = (download, artifact_store.path(download.checksums))
+            elif state.is_verified(dir / download.filename, download.checksums):
+                sources[name] = (download, dir / download.filename)
+            else:
+                missing[name] = download
+    state_dir = root_dir / common.STATE_DIR
+    state_dir.mkdir(exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=state_dir, prefix='bundle-') as tmp:
+        # anything not already on this machine is fetched (through the store, if enabled)
+        staging = []
+        for i, (name, download) in enumerate(missing.items()):
+            dir = pathlib.Path(tmp) / str(i)
+            dir.mkdir()
+            staging.append((download, dir, None))
+            sources[name] = (download, dir / download.filename)
+        if staging:
+            progress = provision.DownloadProgress(len(staging))
+            scheduler = provision.DownloadScheduler(workers, host_workers, progress, artifact_store)
+            await scheduler.arun(staging)
+        return await common.to_thread(_write_bundle, lock, sources, path)
+
+
+def export_bundle(lock, root_dir, path, workers=None, host_workers=provision.DEFAULT_HOST_WORKERS,
+                  artifact_store=None):
+    coro = aexport_bundle(lock, root_dir, path, workers, host_workers, artifact_store)
+    return common.run(coro, workers)
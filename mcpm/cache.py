@@ -0,0 +1,230 @@
+import email.utils
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import mcpm.common as common
+import mcpm.client as client
+import mcpm.trace as trace
+
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_TTL = 60 # used when the server sends no freshness information
+NEGATIVE_TTL = 5 * 60
+CACHEABLE_STATUSES = { 200, 404, 410 } # anything else (429, 408, 5xx, ...) may well succeed on the next try
+EVICT_INTERVAL = 64
+
+
+def _parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        key, _, arg = part.strip().partition('=')
+        if key:
+            directives[key.lower()] = arg.strip('"')
+    return directives
+
+
+def _parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _expiry(status, headers, now):
+    directives = _parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return now
+    if 'max-age' in directives:
+        try:
+            return now + int(directives['max-age'])
+        except ValueError:
+            pass
+    expires = _parse_http_date(headers.get('Expires'))
+    if expires is not None:
+        return expires
+    return now + (NEGATIVE_TTL if status >= 400 else DEFAULT_TTL)
+
+
+class ResponseCache:
+
+    def __init__(self, dir, max_size=DEFAULT_MAX_SIZE, refresh=False):
+        self._dir = dir
+        self._max_size = max_size
+        self._refresh = refresh
+        self._lock = threading.Lock()
+        self._stores = 0
+
+    @property
+    def dir(self):
+        return self._dir
+
+    @property
+    def refresh(self):
+        return self._refresh
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self._dir / key[:2] / f'{key}.json'
+
+    def _load(self, url):
+        path = self._path(url)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path) # mtime doubles as the LRU timestamp
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def _store(self, url, entry):
+        path = self._path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=path.parent, suffix='.tmp', delete=False) as f:
+            json.dump(entry, f)
+        os.replace(f.name, path)
+        with self._lock:
+            self._stores += 1
+            evict = self._stores % EVICT_INTERVAL == 1
+        if evict:
+            self.evict()
+
+    def evict(self, max_size=None, max_age=None):
+        if max_size is None:
+            max_size = self._max_size
+        entries = []
+        for path in self._dir.glob('*/*.json'):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        removed = 0
+        freed = 0
+        for mtime, size, path in entries:
+            if total <= max_size and (max_age is None or now - mtime <= max_age):
+                break
+            try:
+                path.unlink()
+                removed += 1
+                freed += size
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed, freed
+
+    def _request(self, url, entry):
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        with client.get_client().get(url, headers=headers) as response:
+            return response.status, response.headers, response.read()
+
+    def get(self, url, immutable=False):
+        with trace.span('cache', 'cache', url=url) as span:
+            status, body, result = self._get(url, immutable)
+            span.set(result=result)
+            return status, body
+
+    def _get(self, url, immutable):
+        entry = self._load(url)
+        now = time.time()
+        if entry is not None and entry.get('immutable'):
+            return entry['status'], entry['body'].encode(), 'fresh'
+        if entry is not None and not self._refresh and now < entry['expires']:
+            return entry['status'], entry['body'].encode(), 'fresh'
+        try:
+            status, headers, body = self._request(url, entry)
+        except OSError:
+            if entry is not None:
+                return entry['status'], entry['body'].encode(), 'stale'
+            raise
+        if status == 304 and entry is not None:
+            expires = _expiry(entry['status'], headers, now)
+            if expires is not None:
+                entry['expires'] = expires
+                self._store(url, entry)
+            return entry['status'], entry['body'].encode(), 'revalidated'
+        if status not in CACHEABLE_STATUSES and entry is not None:
+            return entry['status'], entry['body'].encode(), 'stale'
+        expires = _expiry(status, headers, now)
+        if expires is not None and status in CACHEABLE_STATUSES:
+            self._store(url, {
+                'url': url,
+                'status': status,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'expires': expires,
+                'immutable': immutable and status == 200,
+                'body': body.decode(),
+            })
+        return status, body, 'miss'
+
+    def put_json(self, url, value, immutable=False):
+        # stores what a request to url would have returned, e.g. the same
+        # object served under an alias
+        if immutable:
+            entry = self._load(url)
+            if entry is not None and entry.get('immutable'):
+                return
+        self._store(url, {
+            'url': url,
+            'status': 200,
+            'etag': None,
+            'last_modified': None,
+            'expires': time.time() + DEFAULT_TTL,
+            'immutable': immutable,
+            'body': json.dumps(value),
+        })
+
+    def get_json(self, url, immutable=False):
+        status, body = self.get(url, immutable)
+        try:
+            return json.loads(body)
+        except ValueError:
+            if status >= 400:
+                raise client.HttpStatusError(url, status)
+            raise
+
+
+_cache = None
+_settings = {}
+
+
+def configure(**kwargs):
+    global _cache
+    _settings.update(kwargs)
+    _cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(common.get_cache_dir() / 'metadata', **_settings)
+    return _cache
+
+
+def get_json(url, immutable=False):
+    return get_cache().get_json(url, immutable)
+
+
+def put_json(url, value, immutable=False):
+    get_cache().put_json(url, value, immutable)
+
+
+def post_json(url, payload):
+    headers = { 'Content-Type': 'application/json' }
+    with client.get_client().post(url, json.dumps(payload).encode(), headers=headers) as response:
+        return json.loads(response.raise_for_status().read())
@@ -0,0 +1,128 @@
+import json
+import sqlite3
+import threading
+import time
+import mcpm.common as common
+
+
+# A local index of Paper-family projects -> game versions -> builds -> downloads.
+# The paper backend keeps it in sync; everything else reads from it.
+
+CATALOG_FILE = 'catalog.sqlite'
+SCHEMA = '''
+create table if not exists versions (
+    project text not null,
+    version text not null,
+    position integer not null,
+    build_ids text,
+    primary key (project, version)
+);
+create table if not exists builds (
+    project text not null,
+    version text not null,
+    build integer not null,
+    channel text not null,
+    filename text not null,
+    url text not null,
+    checksums text not null,
+    size integer,
+    primary key (project, version, build)
+);
+create table if not exists synced (
+    key text primary key,
+    time real not null
+);
+'''
+
+
+class Catalog:
+
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def synced_at(self, key):
+        rows = self._query('select time from synced where key = ?', key)
+        return rows[0][0] if rows else None
+
+    def _mark_synced(self, key):
+        self._db.execute('insert or replace into synced (key, time) values (?, ?)', (key, time.time()))
+
+    def set_versions(self, project, versions):
+        # versions are (version, build ids or None), newest first
+        with self._lock, self._db:
+            self._db.execute('delete from versions where project = ?', (project,))
+            self._db.executemany(
+                    'insert into versions (project, version, position, build_ids) values (?, ?, ?, ?)',
+                    [
+                        (project, version, i, json.dumps(build_ids) if build_ids is not None else None)
+                        for i, (version, build_ids) in enumerate(versions)
+                    ]
+                )
+            self._mark_synced(project)
+
+    def get_versions(self, project):
+        rows = self._query('select version, build_ids from versions where project = ? order by position', project)
+        return [ (version, json.loads(build_ids) if build_ids else None) for version, build_ids in rows ]
+
+    def get_build_ids(self, project, version):
+        rows = self._query('select build_ids from versions where project = ? and version = ?', project, version)
+        return json.loads(rows[0][0]) if rows and rows[0][0] else None
+
+    def last_build(self, project, version):
+        rows = self._query('select max(build) from builds where project = ? and version = ?', project, version)
+        return rows[0][0]
+
+    def add_builds(self, project, version, builds):
+        # builds are (build, channel, DownloadRecord)
+        with self._lock, self._db:
+            self._db.executemany(
+                    '''insert or replace into builds (project, version, build, channel, filename, url, checksums, size)
+                       values (?, ?, ?, ?, ?, ?, ?, ?)''',
+                    [
+                        (project, version, build, channel, download.filename, download.url,
+                         json.dumps(download.checksums), download.size)
+                        for build, channel, download in builds
+                    ]
+                )
+            self._mark_synced(f'{project}/{version}')
+
+    def get_builds(self, project, version, channel=None):
+        sql = 'select build, channel, filename, url, checksums, size from builds where project = ? and version = ?'
+        params = [ project, version ]
+        if channel is not None:
+            sql += ' and channel = ?'
+            params.append(channel)
+        rows = self._query(sql + ' order by build desc', *params)
+        return [
+            (build, channel, common.DownloadRecord(url, filename, json.loads(checksums), size))
+            for build, channel, filename, url, checksums, size in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog(common.get_cache_dir() / CATALOG_FILE)
+        return _catalog
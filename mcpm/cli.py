@@ -1,7 +1,24 @@
 import argparse
+import contextlib
+import json
+import pathlib
+import sys
 import mcpm.config as config
-import mcpm.api as api
-import mcpm.provision as provision
+import mcpm.common as common
+
+# everything below is only needed once a command does real work
+api = common.lazy_import('mcpm.api')
+provision = common.lazy_import('mcpm.provision')
+fleet = common.lazy_import('mcpm.fleet')
+cache = common.lazy_import('mcpm.cache')
+client = common.lazy_import('mcpm.client')
+store = common.lazy_import('mcpm.store')
+bundle = common.lazy_import('mcpm.bundle')
+trace = common.lazy_import('mcpm.trace')
+generations = common.lazy_import('mcpm.generations')
+
+DEFAULT_GC_MAX_AGE = 30
+REVALIDATING_COMMANDS = { 'upgrade', 'outdated' } # report what the server has now, not what was cached
 
 
 def get_init_parser(subparsers):
@@ -33,13 +50,77 @@ def get_upgrade_parser(subparsers):
 
 
 def get_provision_parser(subparsers):
-    subparsers.add_parser('provision', help='provision a Minecraft server in the current directory')
+    subparser = subparsers.add_parser('provision', help='provision a Minecraft server in the current directory')
+    subparser.add_argument('--host-jobs', type=int, default=common.DEFAULT_HOST_WORKERS,
+                           help=f'maximum concurrent downloads per host (default: {common.DEFAULT_HOST_WORKERS})')
+    subparser.add_argument('--link-mode', choices=common.LINK_MODES, default='auto',
+                           help='how jars are placed from the shared artifact store (default: auto)')
+    subparser.add_argument('--no-store', action='store_true',
+                           help='download jars directly, bypassing the shared artifact store')
+    subparser.add_argument('--verify', action='store_true',
+                           help='rehash every jar instead of trusting the verified-state manifest')
+    subparser.add_argument('--frozen', action='store_true',
+                           help='provision strictly from mcpm.lock, failing if it is out of date with mcpm.toml')
+    subparser.add_argument('--offline', action='store_true',
+                           help='like --frozen, and only use jars already in the artifact store')
+    subparser.add_argument('--from-bundle', type=pathlib.Path, metavar='FILE',
+                           help="like --frozen, and take jars from a bundle made with 'mcpm bundle export'")
+    subparser.add_argument('--stale', choices=common.STALE_MODES, default='remove',
+                           help='what to do with jars an earlier provision placed that mcpm.lock no longer lists '
+                                '(default: remove; quarantine moves them to .mcpm/quarantine)')
+    subparser.add_argument('--staged', action='store_true',
+                           help='build the new jar set under .mcpm/generations while the server runs, then switch '
+                                "over at once (undo with 'mcpm rollback')")
+
+
+def get_rollback_parser(subparsers):
+    subparsers.add_parser('rollback', help='switch back to the previous staged generation')
+
+
+def get_bundle_parser(subparsers):
+    subparser = subparsers.add_parser('bundle', help='move the locked jars between machines as a single archive')
+    subsubparsers = subparser.add_subparsers(dest='bundle_command', required=True)
+    export_parser = subsubparsers.add_parser('export', help='pack every jar in mcpm.lock into a bundle')
+    export_parser.add_argument('-o', '--output', type=pathlib.Path,
+                               help='where to write the bundle (default: mcpm-bundle.tar)')
+    export_parser.add_argument('--host-jobs', type=int, default=common.DEFAULT_HOST_WORKERS,
+                               help=f'maximum concurrent downloads per host (default: {common.DEFAULT_HOST_WORKERS})')
+    export_parser.add_argument('--no-store', action='store_true',
+                               help='download missing jars directly, bypassing the shared artifact store')
+
+
+def get_gc_parser(subparsers):
+    subparser = subparsers.add_parser('gc', help='evict old entries from the shared artifact store and metadata cache')
+    subparser.add_argument('--max-size', metavar='SIZE',
+                           help='shrink the artifact store to at most SIZE (e.g. 2G), least recently used first')
+    subparser.add_argument('--max-age', type=float, metavar='DAYS', default=DEFAULT_GC_MAX_AGE,
+                           help=f'evict anything unused for more than DAYS days (default: {DEFAULT_GC_MAX_AGE})')
+
+
+def get_outdated_parser(subparsers):
+    subparser = subparsers.add_parser('outdated', help='list newer versions of the locked server and plugins')
+    subparser.add_argument('--all', action='store_true', help='list up-to-date entries too')
+    subparser.add_argument('--json', action='store_true', help='print the comparison as json')
+
+
+def get_versions_parser(subparsers):
+    subparser = subparsers.add_parser('versions', help='list the game versions and builds a server is available for')
+    subparser.add_argument('server', nargs='?', default='paper', help='paper, folia, velocity, ... (default: paper)')
+    subparser.add_argument('game_version', nargs='?', help='list the stable builds for this game version instead')
 
 
 def get_parser():
-    extra_parsers = [ get_init_parser, get_lock_parser, get_add_parser, get_remove_parser, get_upgrade_parser, get_provision_parser ]
+    extra_parsers = [ get_init_parser, get_lock_parser, get_add_parser, get_remove_parser, get_upgrade_parser, get_provision_parser, get_bundle_parser, get_versions_parser, get_outdated_parser, get_gc_parser, get_rollback_parser ]
 
     parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=common.DEFAULT_WORKERS,
+                        help=f'number of concurrent network requests (default: {common.DEFAULT_WORKERS})')
+    parser.add_argument('--refresh', action='store_true',
+                        help='revalidate all cached API responses')
+    parser.add_argument('--fleet', type=pathlib.Path, metavar='DIR',
+                        help='run lock, upgrade, provision or outdated on every mcpm.toml found under DIR')
+    parser.add_argument('--profile', type=pathlib.Path, metavar='FILE',
+                        help='write a chrome trace of every request, download and hash to FILE and print a summary')
 
     subparsers = parser.add_subparsers(dest='command', required=True)
     for extra_parser in extra_parsers:
@@ -48,9 +129,13 @@ def get_parser():
     return parser
 
 
-def _update_lock(cfg):
-    lock = config.get_lock(cfg)
-    config.update_lock(cfg, lock)
+def _update_lock(cfg, args):
+    lock = config.read_lock(cfg)
+    if lock is not None and config.is_lock_current(cfg, lock):
+        return lock # nothing in mcpm.toml changed since this lock was resolved
+    if lock is None:
+        lock = config.new_lock(cfg)
+    config.update_lock(cfg, lock, args.jobs)
     config.write_lock(cfg, lock)
     return lock
 
@@ -61,15 +146,15 @@ def init_cmd(args):
 
 
 def lock_cmd(args):
-    cfg = config.get_config()
-    _update_lock(cfg)
+    cfg = config.get_config(readonly=True)
+    _update_lock(cfg, args)
 
 
 def add_cmd(args):
     cfg = config.get_config()
     for plugin in args.plugin:
         cfg.add_plugin(plugin)
-    _update_lock(cfg)
+    _update_lock(cfg, args)
     config.save_config(cfg)
 
 
@@ -77,36 +162,44 @@ def remove_cmd(args):
     cfg = config.get_config()
     for plugin in args.plugin:
         cfg.remove_plugin(plugin)
-    _update_lock(cfg)
+    _update_lock(cfg, args)
     config.save_config(cfg)
 
 
+def _upgrade_dependencies(cfg, lock, args):
+    # upgraded plugins may need new dependencies, or no longer need old ones
+    config.lock_dependencies(cfg, lock, args.jobs)
+    config.prune_lock(cfg, lock)
+
+
 def upgrade_server_cmd(args):
-    cfg = config.get_config()
+    cfg = config.get_config(readonly=True)
     lock = config.get_lock(cfg)
     api.upgrade_server(lock)
     config.write_lock(cfg, lock)
 
 
 def upgrade_plugins_cmd(args):
-    cfg = config.get_config()
+    cfg = config.get_config(readonly=True)
     lock = config.get_lock(cfg)
-    api.upgrade_plugins(lock, *args.plugin)
+    api.upgrade_plugins(lock, *args.plugin, workers=args.jobs)
+    _upgrade_dependencies(cfg, lock, args)
     config.write_lock(cfg, lock)
 
 
 def upgrade_all_cmd(args):
-    cfg = config.get_config()
+    cfg = config.get_config(readonly=True)
     lock = config.get_lock(cfg)
     api.upgrade_server(lock)
-    api.upgrade_plugins(lock)
+    api.upgrade_plugins(lock, workers=args.jobs)
+    _upgrade_dependencies(cfg, lock, args)
     config.write_lock(cfg, lock)
 
 
 def upgrade_full_cmd(args):
-    cfg = config.get_config()
+    cfg = config.get_config(readonly=True)
     lock = config.new_lock(cfg)
-    config.update_lock(cfg, lock)
+    config.update_lock(cfg, lock, args.jobs)
     config.write_lock(cfg, lock)
 
 
@@ -122,15 +215,175 @@ def upgrade_cmd(args):
     commands[args.upgrade_command](args)
 
 
-def provision_cmd(args):
-    cfg = config.get_config()
-    lock = _update_lock(cfg)
-    provision.provision(cfg, lock)
+def _get_store(args):
+    if args.offline:
+        args.frozen = True
+        if args.no_store:
+            raise common.McpmError('--offline needs the artifact store, it cannot be combined with --no-store.')
+    if args.no_store:
+        return None
+    store.configure(link_mode=args.link_mode, offline=args.offline)
+    return store.get_store()
 
 
-def main():
-    parser = get_parser()
-    args = parser.parse_args()
+def _open_bundle(args):
+    if args.from_bundle is None:
+        return None
+    args.frozen = True
+    return bundle.Bundle(args.from_bundle)
+
+
+def _print_pruned(cfg, results):
+    pruned = { path: status for path, status in results.items() if status in ('removed', 'quarantined', 'unlinked') }
+    for path, status in sorted(pruned.items()):
+        print(f'{status}: {path.relative_to(cfg.root_dir)}')
+    return pruned
+
+
+def staged_provision_cmd(args, cfg, lock, artifact_store, source):
+    number, _ = generations.stage(
+            lock, cfg.root_dir, workers=args.jobs, host_workers=args.host_jobs,
+            store=artifact_store, bundle=source
+        )
+    _print_pruned(cfg, generations.activate(cfg.root_dir, number, args.stale))
+    generations.prune_generations(cfg.root_dir)
+    print(f"Generation {number} is live, 'mcpm rollback' switches back to the previous one.")
+
+
+def provision_cmd(args):
+    cfg = config.get_config(readonly=True)
+    artifact_store = _get_store(args)
+    with _open_bundle(args) or contextlib.nullcontext() as source:
+        if args.frozen:
+            lock = config.get_frozen_lock(cfg)
+        else:
+            lock = _update_lock(cfg, args)
+        if args.staged:
+            return staged_provision_cmd(args, cfg, lock, artifact_store, source)
+        results = provision.provision(
+                cfg, lock, workers=args.jobs, host_workers=args.host_jobs,
+                store=artifact_store, verify=args.verify, bundle=source, stale=args.stale
+            )
+    pruned = _print_pruned(cfg, results)
+    if args.verify:
+        results = { path: status for path, status in results.items() if path not in pruned }
+        changed = {
+            path: status for path, status in results.items()
+            if status not in ('unchanged', 'verified')
+        }
+        for path, status in sorted(changed.items()):
+            print(f'{status}: {path.relative_to(cfg.root_dir)}')
+        print(f'{len(results)} file(s) verified, {len(changed)} changed.')
+
+
+def bundle_export_cmd(args):
+    cfg = config.get_config(readonly=True)
+    lock = config.get_frozen_lock(cfg)
+    artifact_store = None if args.no_store else store.get_store()
+    if args.output is None:
+        args.output = pathlib.Path(bundle.DEFAULT_BUNDLE_NAME)
+    index = bundle.export_bundle(
+            lock, cfg.root_dir, args.output, args.jobs, args.host_jobs,
+            artifact_store=artifact_store
+        )
+    size = sum(artifact['size'] for artifact in index['artifacts'])
+    print(f"{len(index['artifacts'])} jar(s), {provision.format_size(size)} written to {args.output}.")
+
+
+def bundle_cmd(args):
+    commands = {
+        "export": bundle_export_cmd,
+    }
+    commands[args.bundle_command](args)
+
+
+def rollback_cmd(args):
+    cfg = config.get_config(readonly=True)
+    number, results = generations.rollback(cfg.root_dir)
+    _print_pruned(cfg, results)
+    print(f'Generation {number} is live again. mcpm.lock still describes the newer one.')
+
+
+def gc_cmd(args):
+    max_age = args.max_age * 24 * 60 * 60
+    max_size = provision.parse_size(args.max_size) if args.max_size is not None else None
+    removed, freed = store.get_store().evict(max_size, max_age)
+    print(f'artifact store: {removed} file(s) removed, {provision.format_size(freed)} freed.')
+    removed, freed = cache.get_cache().evict(max_age=max_age)
+    print(f'metadata cache: {removed} response(s) removed, {provision.format_size(freed)} freed.')
+
+
+def _print_outdated(entries, show_all):
+    rows = [ entry for entry in entries if show_all or entry['outdated'] or 'error' in entry ]
+    if not rows:
+        print('Everything in mcpm.lock is up to date.')
+        return
+    width = max(len(entry['name']) for entry in rows)
+    print(f"{'name':<{width}} {'source':<10} {'current':<20} latest")
+    for entry in rows:
+        latest = entry['latest'] if 'error' not in entry else f"error: {entry['error']}"
+        print(f"{entry['name']:<{width}} {entry['source']:<10} {entry['current']:<20} {latest}")
+
+
+def outdated_cmd(args):
+    cfg = config.get_config(readonly=True)
+    lock = config.read_lock(cfg)
+    if lock is None:
+        raise common.McpmError("There is no mcpm.lock to compare against. Run 'mcpm lock' first.")
+    entries = api.outdated(lock, args.jobs)
+    if args.json:
+        json.dump(entries, sys.stdout, indent=2)
+        print()
+    else:
+        _print_outdated(entries, args.all)
+
+
+def versions_cmd(args):
+    if args.game_version is None:
+        for version, build in api.list_server_versions(args.server):
+            print(version if build is None else f'{version:<16} latest build {build}')
+        return
+    if args.server not in api.SERVER_BACKENDS:
+        raise common.McpmError(f'Unknown server {args.server}.')
+    for version in api.iter_server_versions(args.server, args.game_version):
+        print(f'{version.version:<24} {version.channel:<8} {version.downloads[0].filename}')
+
+
+def fleet_cmd(args):
+    workspaces = fleet.find_workspaces(args.fleet)
+    source = None
+    if args.command == 'lock':
+        coro = fleet.alock(workspaces, args.jobs)
+    elif args.command == 'upgrade':
+        target = args.upgrade_command or 'all'
+        plugins = args.plugin if target == 'plugins' else ()
+        coro = fleet.aupgrade(workspaces, args.jobs, target, plugins)
+    elif args.command == 'provision':
+        if args.staged:
+            raise common.McpmError('--staged is not supported with --fleet yet.')
+        artifact_store = _get_store(args)
+        source = _open_bundle(args)
+        coro = fleet.aprovision(
+                workspaces, args.jobs, args.host_jobs,
+                store=artifact_store, verify=args.verify, frozen=args.frozen, bundle=source,
+                stale=args.stale
+            )
+    elif args.command == 'outdated':
+        coro = fleet.aoutdated(workspaces, args.jobs)
+    else:
+        raise common.McpmError(f"'{args.command}' is not supported with --fleet.")
+    with source or contextlib.nullcontext():
+        common.run(coro, args.jobs)
+    if args.command == 'outdated' and args.json:
+        json.dump(fleet.outdated_report(workspaces, args.fleet), sys.stdout, indent=2)
+        print()
+        return 1 if any(ws.error is not None for ws in workspaces) else 0
+    return 1 if fleet.print_summary(workspaces, args.fleet) else 0
+
+
+def run_cmd(args):
+    if args.fleet is not None:
+        return fleet_cmd(args)
     commands = {
         "init": init_cmd,
         "lock": lock_cmd,
@@ -138,5 +391,27 @@ def main():
         "remove": remove_cmd,
         "upgrade": upgrade_cmd,
         "provision": provision_cmd,
+        "bundle": bundle_cmd,
+        "versions": versions_cmd,
+        "outdated": outdated_cmd,
+        "gc": gc_cmd,
+        "rollback": rollback_cmd,
     }
-    commands[args.command](args)
+    return commands[args.command](args)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.refresh or args.command in REVALIDATING_COMMANDS:
+        cache.configure(refresh=True)
+    if args.jobs != common.DEFAULT_WORKERS:
+        client.configure(pool_size=args.jobs) # the default needs no setup, and loading the client isn't free
+    if args.profile is None:
+        return run_cmd(args)
+    tracer = trace.enable()
+    try:
+        return run_cmd(args)
+    finally:
+        tracer.write(args.profile)
+        tracer.print_summary()
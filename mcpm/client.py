@@ -0,0 +1,428 @@
+import base64
+import http.client
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zlib
+import mcpm.common as common
+import mcpm.trace as trace
+
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+BACKOFF_BASE = 0.5
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 256 * 1024
+REDIRECT_STATUSES = { 301, 302, 303, 307, 308 }
+RETRY_STATUSES = { 500, 502, 503, 504 }
+RATE_LIMIT_STATUS = 429
+RATE_LIMIT_RETRIES = 5 # 429s are waited out, they don't count against the regular retries
+RATE_LIMIT_DELAY = 1.0 # when a 429 doesn't say how long to wait
+RESET_MARGIN = 0.5 # reset headers are rounded to whole seconds
+RETRY_EXCEPTIONS = (
+    http.client.RemoteDisconnected,
+    http.client.IncompleteRead,
+    ConnectionError,
+    socket.timeout,
+)
+
+
+class HttpStatusError(common.ApiError):
+
+    def __init__(self, url, status):
+        self._url = url
+        self._status = status
+        super().__init__(f'{url} returned HTTP {status}.')
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def status(self):
+        return self._status
+
+
+def _backoff(attempt):
+    return random.uniform(0, BACKOFF_BASE * 2 ** attempt)
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # Schedules the requests to one host. Hosts that publish their quota
+    # (X-Ratelimit-Limit, -Remaining and -Reset, as Modrinth does) get a token
+    # bucket: requests draw from what the last response said is left, wait for
+    # the window to reset once it runs dry, and are refilled to the limit then.
+    # Concurrency grows by one per accepted response and halves when a 429 comes.
+    # Hosts that never send the headers or a 429 aren't limited at all.
+
+    def __init__(self, max_concurrency):
+        self._max_concurrency = max(1, max_concurrency)
+        self._concurrency = self._max_concurrency
+        self._cond = threading.Condition()
+        self._active = False
+        self._limit = None
+        self._tokens = None
+        self._reset_at = 0.0
+        self._in_flight = 0
+
+    @property
+    def concurrency(self):
+        return self._concurrency
+
+    def _ready(self, now):
+        if self._tokens is not None and self._tokens <= 0 and now >= self._reset_at:
+            self._tokens = self._limit or 1 # without a known limit, probe with one request
+        if self._tokens is not None and self._tokens <= 0:
+            return False
+        return not self._active or self._in_flight < self._concurrency
+
+    def acquire(self):
+        # returns the seconds spent queued
+        start = time.monotonic()
+        with self._cond:
+            while not self._ready(time.monotonic()):
+                timeout = None
+                if self._tokens is not None and self._tokens <= 0:
+                    timeout = max(0.0, self._reset_at - time.monotonic())
+                self._cond.wait(timeout)
+            self._in_flight += 1
+            if self._tokens is not None:
+                self._tokens -= 1
+        return time.monotonic() - start
+
+    def release(self, status=None, headers=None):
+        with self._cond:
+            self._in_flight -= 1
+            if headers is not None:
+                self._update(status, headers)
+            self._cond.notify_all()
+
+    def _update(self, status, headers):
+        now = time.monotonic()
+        limit = _header_number(headers, 'X-Ratelimit-Limit')
+        remaining = _header_number(headers, 'X-Ratelimit-Remaining')
+        reset = _header_number(headers, 'X-Ratelimit-Reset')
+        if reset is not None and reset > 1e9:
+            reset -= time.time() # an epoch timestamp rather than seconds left
+        if status == RATE_LIMIT_STATUS:
+            delay = _header_number(headers, 'Retry-After')
+            if delay is None:
+                delay = reset if reset is not None else RATE_LIMIT_DELAY
+            if now >= self._reset_at:
+                self._concurrency = max(1, self._concurrency // 2) # once per window, not per rejected request
+            self._active = True
+            self._tokens = 0
+            self._reset_at = max(self._reset_at, now + max(0.0, delay) + RESET_MARGIN)
+            return
+        if self._active and status is not None and status < 400:
+            self._concurrency = min(self._max_concurrency, self._concurrency + 1)
+        if remaining is None:
+            if self._limit is None and now >= self._reset_at:
+                self._tokens = None # a host without quota headers is over its 429
+            return
+        self._active = True
+        if limit is not None:
+            self._limit = int(limit)
+        # requests still in flight were sent after this one, the server hasn't counted them yet
+        tokens = max(0, int(remaining) - self._in_flight)
+        reset_at = now + max(0.0, reset or 0.0) + RESET_MARGIN
+        if self._tokens is None or reset_at > self._reset_at + 1:
+            self._tokens = tokens # a new window
+            self._reset_at = reset_at
+        else:
+            self._tokens = min(self._tokens, tokens) # responses can arrive out of order
+
+
+def get_proxy(scheme, netloc):
+    # honours HTTP(S)_PROXY and NO_PROXY the way urllib does
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(netloc):
+        return None
+    if '://' not in proxy:
+        proxy = f'http://{proxy}'
+    parts = urllib.parse.urlsplit(proxy)
+    if parts.scheme != 'http':
+        raise common.ApiError(f'Unsupported proxy scheme in {proxy}, only http:// proxies are supported.')
+    return parts
+
+
+class ConnectionPool:
+
+    def __init__(self, scheme, netloc, maxsize, timeout, proxy=None):
+        self._scheme = scheme
+        self._netloc = netloc
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._proxy = proxy
+        self._proxy_headers = {}
+        if proxy is not None and proxy.username is not None:
+            credentials = f'{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or "")}'
+            self._proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @property
+    def forwarding(self):
+        # plain http goes through the proxy as is, https is tunneled with CONNECT
+        return self._proxy is not None and self._scheme == 'http'
+
+    @property
+    def proxy_headers(self):
+        return self._proxy_headers
+
+    def get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        if self._proxy is None:
+            if self._scheme == 'https':
+                return http.client.HTTPSConnection(self._netloc, timeout=self._timeout), False
+            return http.client.HTTPConnection(self._netloc, timeout=self._timeout), False
+        proxy_netloc = self._proxy.netloc.rpartition('@')[2]
+        if self._scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy_netloc, timeout=self._timeout)
+            conn.set_tunnel(self._netloc, headers=self._proxy_headers)
+            return conn, False
+        return http.client.HTTPConnection(proxy_netloc, timeout=self._timeout), False
+
+    def put(self, conn):
+        with self._lock:
+            if len(self._idle) < self._maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Response:
+
+    def __init__(self, url, resp, conn, pool, span=trace.NULL_SPAN):
+        self._url = url
+        self._resp = resp
+        self._conn = conn
+        self._pool = pool
+        self._span = span
+        self._decoder = None
+        self._buffer = b''
+        encoding = resp.getheader('Content-Encoding', '').lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            self._decoder = zlib.decompressobj(zlib.MAX_WBITS | 32) # accepts gzip and zlib framing
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def status(self):
+        return self._resp.status
+
+    @property
+    def headers(self):
+        return self._resp.headers
+
+    @property
+    def span(self):
+        return self._span
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            self.close()
+            raise HttpStatusError(self._url, self.status)
+        return self
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._resp.will_close:
+            self._conn.close()
+        else:
+            self._pool.put(self._conn)
+        self._conn = None
+
+    def _read_raw(self, amt):
+        data = self._resp.read(amt) if amt is not None else self._resp.read()
+        self._span.add('bytes', len(data))
+        if self._resp.isclosed():
+            self._release()
+        return data
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            return self._read_raw(amt)
+        while amt is None or len(self._buffer) < amt:
+            raw = self._read_raw(CHUNK_SIZE)
+            if not raw:
+                self._buffer += self._decoder.flush()
+                break
+            self._buffer += self._decoder.decompress(raw)
+        if amt is None:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            if self._resp.isclosed():
+                self._release()
+            else:
+                self._conn.close() # unread body, the connection can't be reused
+                self._conn = None
+        self._resp.close()
+        self._span.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HttpClient:
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, pool_size=common.DEFAULT_WORKERS):
+        self._timeout = timeout
+        self._retries = retries
+        self._pool_size = pool_size
+        self._pools = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, scheme, netloc):
+        with self._lock:
+            key = (scheme, netloc)
+            if key not in self._pools:
+                proxy = get_proxy(scheme, netloc)
+                self._pools[key] = ConnectionPool(scheme, netloc, self._pool_size, self._timeout, proxy)
+            return self._pools[key]
+
+    def limiter(self, url):
+        netloc = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if netloc not in self._limiters:
+                self._limiters[netloc] = RateLimiter(self._pool_size) # -j, via configure()
+            return self._limiters[netloc]
+
+    def _send(self, method, url, headers, body):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise common.ApiError(f'Unsupported URL scheme in {url}.')
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        pool = self._pool(parts.scheme, parts.netloc)
+        if pool.forwarding:
+            path = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+            headers = { **headers, **pool.proxy_headers }
+        while True:
+            conn, reused = pool.get()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return Response(url, conn.getresponse(), conn, pool)
+            except BaseException as e:
+                conn.close()
+                if reused and isinstance(e, RETRY_EXCEPTIONS):
+                    continue # the server dropped an idle keep-alive connection
+                raise
+
+    def request(self, method, url, headers=None, body=None, decode=True):
+        all_headers = {
+            'User-Agent': common.USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate' if decode else 'identity',
+        }
+        all_headers.update(headers or {})
+        span = trace.span(f'{method} {url}', 'http', url=url)
+        attempt = 0
+        redirects = 0
+        throttled = 0
+        while True:
+            limiter = self.limiter(url)
+            queued = limiter.acquire()
+            if queued > 0.001:
+                span.add('queued', round(queued, 3))
+            try:
+                response = self._send(method, url, all_headers, body)
+            except RETRY_EXCEPTIONS as e:
+                limiter.release()
+                if attempt >= self._retries:
+                    span.finish(e)
+                    raise
+                attempt += 1
+                span.set(retries=attempt)
+                time.sleep(_backoff(attempt))
+                continue
+            except BaseException as e:
+                limiter.release()
+                span.finish(e)
+                raise
+            limiter.release(response.status, response.headers)
+            if response.status == RATE_LIMIT_STATUS and throttled < RATE_LIMIT_RETRIES:
+                # the limiter holds this host's requests back until the window resets
+                response.read()
+                response.close()
+                throttled += 1
+                span.set(throttled=throttled)
+                continue
+            if response.status in REDIRECT_STATUSES and 'Location' in response.headers:
+                response.read()
+                response.close()
+                redirects += 1
+                if redirects > MAX_REDIRECTS:
+                    raise common.ApiError(f'Too many redirects while fetching {url}.')
+                url = urllib.parse.urljoin(url, response.headers['Location'])
+                span.set(redirects=redirects, url=url)
+                if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                    method, body = 'GET', None
+                continue
+            if response.status in RETRY_STATUSES and attempt < self._retries:
+                response.read()
+                response.close()
+                attempt += 1
+                span.set(retries=attempt)
+                time.sleep(_backoff(attempt))
+                continue
+            span.set(status=response.status)
+            response._span = span
+            return response
+
+    def get(self, url, headers=None, decode=True):
+        return self.request('GET', url, headers=headers, decode=decode)
+
+    def post(self, url, body, headers=None):
+        return self.request('POST', url, headers=headers, body=body)
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
+
+
+_client = None
+_settings = {}
+
+
+def configure(**kwargs):
+    global _client
+    _settings.update(kwargs)
+    _client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = HttpClient(**_settings)
+    return _client
@@ -1,4 +1,64 @@
+import importlib.util
 import os
+import pathlib
+import sys
+
+
+def lazy_import(name):
+    # the module is only loaded on first attribute access, so commands that
+    # never touch the network don't pay for asyncio, http.client and friends
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+asyncio = lazy_import('asyncio')
+futures = lazy_import('concurrent.futures')
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_HOST_WORKERS = 4
+STATE_DIR = '.mcpm'
+CURRENT_LINK = 'current' # the live staged generation, inside STATE_DIR
+STALE_MODES = [ 'remove', 'quarantine', 'keep' ]
+LINK_MODES = [ 'auto', 'hardlink', 'reflink', 'copy' ]
+USER_AGENT = 'mcpm (https://github.com/woodrowbarlow/mcpm/)'
+
+
+def get_cache_dir():
+    if 'MCPM_CACHE_DIR' in os.environ:
+        return pathlib.Path(os.environ['MCPM_CACHE_DIR'])
+    if 'XDG_CACHE_HOME' in os.environ:
+        return pathlib.Path(os.environ['XDG_CACHE_HOME']) / 'mcpm'
+    return pathlib.Path.home() / '.cache' / 'mcpm'
+
+
+def run(coro, workers=None):
+    if workers is None:
+        workers = DEFAULT_WORKERS
+
+    async def main():
+        executor = futures.ThreadPoolExecutor(max_workers=max(1, workers))
+        asyncio.get_running_loop().set_default_executor(executor)
+        return await coro
+
+    return asyncio.run(main())
+
+
+async def to_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
 
 class ApiError(Exception):
     pass
@@ -7,12 +67,36 @@ class ApiError(Exception):
 class McpmError(Exception):
     pass
 
+
+class AggregateError(McpmError):
+    ACTION = 'process'
+
+    def __init__(self, errors):
+        self._errors = errors
+        lines = [ f'Failed to {self.ACTION} {len(errors)} package(s):' ]
+        lines += [ f'- {name}: {str(err) or type(err).__name__}' for name, err in errors ]
+        super().__init__(os.linesep.join(lines))
+
+    @property
+    def errors(self):
+        return self._errors
+
+
+class ResolutionError(AggregateError):
+    ACTION = 'resolve'
+
+
+class DownloadError(AggregateError):
+    ACTION = 'download'
+
 class DownloadRecord:
+    __slots__ = ('_url', '_filename', '_checksums', '_size')
 
-    def __init__(self, url, filename, checksums):
+    def __init__(self, url, filename, checksums, size=None):
         self._url = url
         self._filename = filename
         self._checksums = checksums
+        self._size = size
 
     @property
     def url(self):
@@ -26,29 +110,41 @@ class DownloadRecord:
     def checksums(self):
         return self._checksums
 
+    @property
+    def size(self):
+        return self._size
+
     def __repr__(self):
         return f'{self.filename} ({self.url})'
 
     def to_dict(self):
-        return {
+        value = {
             'url': self.url,
             'filename': self.filename,
             'checksums': self.checksums,
         }
+        if self.size is not None:
+            value['size'] = self.size
+        return value
 
     @staticmethod
     def from_dict(value):
-        return DownloadRecord(value["url"], value["filename"], value["checksums"])
+        return DownloadRecord(value["url"], value["filename"], value["checksums"], value.get("size"))
 
 
 class VersionRecord:
+    __slots__ = ('_source', '_name', '_version', '_channel', '_downloads', '_dependencies', '_required_by')
 
-    def __init__(self, name, source, version, channel, downloads):
+    def __init__(self, name, source, version, channel, downloads, dependencies=None, required_by=None):
         self._source = source
         self._name = name
         self._version = version
         self._channel = channel
         self._downloads = downloads
+        # required projects, as the source identifies them
+        self._dependencies = dependencies if dependencies is not None else []
+        # locked plugins this one was pulled in for, empty if it is in mcpm.toml
+        self._required_by = required_by if required_by is not None else []
 
     @property
     def name(self):
@@ -70,6 +166,18 @@ class VersionRecord:
     def downloads(self):
         return self._downloads
 
+    @property
+    def dependencies(self):
+        return self._dependencies
+
+    @property
+    def required_by(self):
+        return self._required_by
+
+    @required_by.setter
+    def required_by(self, value):
+        self._required_by = value
+
     def __repr__(self):
         s = f'{self.version} ({self.channel})' + os.linesep
         for download in self.downloads:
@@ -77,13 +185,18 @@ class VersionRecord:
         return s.strip()
 
     def to_dict(self):
-        return {
+        value = {
             'name': self.name,
             'source': self.source,
             'version': self.version,
             'channel': self.channel,
             'downloads': [ o.to_dict() for o in self.downloads ]
         }
+        if self.dependencies:
+            value['dependencies'] = self.dependencies
+        if self.required_by:
+            value['required_by'] = self.required_by
+        return value
 
     @staticmethod
     def from_dict(value):
@@ -91,15 +204,17 @@ class VersionRecord:
         return VersionRecord(
                 value['name'], value['source'],
                 value['version'], value['channel'],
-                downloads
+                downloads, value.get('dependencies'), value.get('required_by')
             )
 
 
 class LockRecord:
+    __slots__ = ('_loader', '_game_version', '_fingerprint', '_server', '_plugins', '_index')
 
-    def __init__(self, loader, game_version, server=None, plugins=None):
+    def __init__(self, loader, game_version, server=None, plugins=None, fingerprint=None):
         self._loader = loader
         self._game_version = game_version
+        self._fingerprint = fingerprint
         if server is not None:
             self._server = server
         else:
@@ -108,6 +223,13 @@ class LockRecord:
             self._plugins = plugins
         else:
             self._plugins = []
+        self._reindex()
+
+    def _reindex(self):
+        # name -> position of the first plugin with that name
+        self._index = {}
+        for i, plugin in enumerate(self._plugins):
+            self._index.setdefault(plugin.name, i)
 
     @property
     def loader(self):
@@ -129,27 +251,52 @@ class LockRecord:
     def plugins(self):
         return self._plugins
 
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, value):
+        self._fingerprint = value
+
     def find_plugin(self, name):
-        for plugin in self.plugins:
-            if plugin.name == name:
-                return plugin
-        return None
+        i = self._index.get(name)
+        return self._plugins[i] if i is not None else None
 
     def add_plugin(self, plugin):
-        self.plugins.append(plugin)
+        self._index.setdefault(plugin.name, len(self._plugins))
+        self._plugins.append(plugin)
+
+    def replace_plugin(self, old, new):
+        i = self._index.get(old.name)
+        if i is None or self._plugins[i] is not old:
+            i = self._plugins.index(old)
+        self._plugins[i] = new
+        if new.name != old.name:
+            self._reindex()
+
+    def sort_plugins(self, plugin_names):
+        order = { name: i for i, name in enumerate(plugin_names) }
+        self._plugins.sort(key=lambda plugin: order.get(plugin.name, len(order)))
+        self._reindex()
 
     def remove_plugins_except(self, plugin_names):
+        plugin_names = set(plugin_names)
         self._plugins = [
             plugin for plugin in self._plugins if plugin.name in plugin_names
         ]
+        self._reindex()
 
     def to_dict(self):
-        return {
+        value = {
             'loader': self.loader,
             'game_version': self.game_version,
             'server': self.server.to_dict(),
             'plugins': [ o.to_dict() for o in self.plugins ],
         }
+        if self.fingerprint is not None:
+            value['fingerprint'] = self.fingerprint
+        return value
 
     @staticmethod
     def from_dict(value):
@@ -159,4 +306,4 @@ class LockRecord:
             server = VersionRecord.from_dict(value['server'])
         if 'plugins' in value:
             plugins = [ VersionRecord.from_dict(r) for r in value['plugins'] ]
-        return LockRecord(value['loader'], value['game_version'], server, plugins)
+        return LockRecord(value['loader'], value['game_version'], server, plugins, value.get('fingerprint'))
@@ -1,16 +1,24 @@
-import tomlkit
+import hashlib
 import json
 import pathlib
 import os
 import mcpm.common as common
-import mcpm.api as api
+
+try:
+    import tomllib
+except ImportError: # python < 3.11
+    tomllib = None
+
+asyncio = common.lazy_import('asyncio')
+tomlkit = common.lazy_import('tomlkit')
+api = common.lazy_import('mcpm.api')
 
 def _find_root_directory(dir=None):
     if dir is None:
         dir = pathlib.Path.cwd()
     if (dir / 'mcpm.toml').is_file():
         return dir
-    if dir.parent:
+    if dir.parent != dir:
         return _find_root_directory(dir.parent)
     return None
 
@@ -25,6 +33,8 @@ def disambiguate_plugin_name(name):
 
 
 class McpmPluginConfig:
+    __slots__ = ('_full_name', '_name', '_source', '_channel')
+
     def __init__(self, full_name):
         self._full_name = full_name
         self._name, self._source, self._channel = disambiguate_plugin_name(full_name)
@@ -62,6 +72,8 @@ class McpmConfig:
         if "plugins" not in self._doc["server"]:
             self._doc["server"]["plugins"] = []
         assert self._doc["server"]["loader"] == "paper" # only supporting paper for now
+        self._plugins = None
+        self._index = None
 
     @property
     def root_dir(self):
@@ -83,16 +95,28 @@ class McpmConfig:
     def loader(self, value):
         self._doc["server"]["loader"] = value
 
+    def _load_plugins(self):
+        # parsed once, add_plugin and remove_plugin keep it up to date
+        if self._plugins is None:
+            self._plugins = []
+            self._index = {}
+            for full_name in self._doc["server"]["plugins"]:
+                self._append_plugin(full_name)
+
     @property
     def plugins(self):
-        for plugin in self._doc["server"]["plugins"]:
-            yield McpmPluginConfig(plugin)
+        self._load_plugins()
+        return self._plugins
+
+    def _append_plugin(self, full_name):
+        plugin = McpmPluginConfig(full_name)
+        self._plugins.append(plugin)
+        self._index.setdefault(plugin.name, []).append(plugin)
 
     def find_plugin(self, name):
         name, source, channel = disambiguate_plugin_name(name)
-        for plugin in self.plugins:
-            if plugin.name != name:
-                continue
+        self._load_plugins()
+        for plugin in self._index.get(name, ()):
             if source is not None and plugin.source != source:
                 continue
             if channel is not None and plugin.channel != channel:
@@ -104,11 +128,13 @@ class McpmConfig:
         name, source, channel = disambiguate_plugin_name(full_name)
         assert self.find_plugin(name) is None
         self._doc["server"]["plugins"].append(full_name)
+        self._append_plugin(full_name)
 
     def remove_plugin(self, name):
         plugin = self.find_plugin(name)
         assert plugin is not None
         self._doc["server"]["plugins"].remove(plugin.full_name)
+        self._plugins = None
 
 def init_config(root_dir=None):
     if root_dir is None:
@@ -130,33 +156,96 @@ def init_config(root_dir=None):
     return McpmConfig(root_dir, doc)
 
 
-def get_config():
-    root_dir = _find_root_directory()
+def find_workspaces(root_dir):
+    return sorted(
+        path.parent for path in root_dir.rglob('mcpm.toml')
+        if common.STATE_DIR not in path.parts
+    )
+
+
+def get_config(root_dir=None, readonly=False):
+    if root_dir is None:
+        root_dir = _find_root_directory()
+    if root_dir is None:
+        raise common.McpmError("No mcpm.toml found in this directory or any parent. Run 'mcpm init' first.")
+    if readonly and tomllib is not None:
+        # much cheaper than tomlkit, but loses the formatting save_config needs
+        with open(root_dir / "mcpm.toml", "rb") as f:
+            return McpmConfig(root_dir, tomllib.load(f))
     with open(root_dir / "mcpm.toml") as f:
         doc = tomlkit.parse(f.read())
     return McpmConfig(root_dir, doc)
 
 
+def get_fingerprint(cfg):
+    inputs = {
+        'loader': str(cfg.loader),
+        'version': str(cfg.version),
+        'plugins': [ str(plugin.full_name) for plugin in cfg.plugins ],
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def is_lock_current(cfg, lock_record):
+    return lock_record.server is not None and lock_record.fingerprint == get_fingerprint(cfg)
+
+
 def save_config(cfg):
     with open(cfg.root_dir / "mcpm.toml", "w") as f:
         f.write(tomlkit.dumps(cfg._doc))
 
 
-def new_lock(cfg):
+async def anew_lock(cfg):
     game_version = cfg.version
     if game_version == "latest":
-        game_version = api.get_latest_game_version(cfg.loader)
+        game_version = await api.aget_latest_game_version(cfg.loader)
     return common.LockRecord(cfg.loader, game_version)
 
 
-def get_lock(cfg):
+def new_lock(cfg):
+    return common.run(anew_lock(cfg))
+
+
+def read_lock(cfg):
     if not (cfg.root_dir / "mcpm.lock").is_file():
-        return new_lock(cfg)
+        return None
     with open(cfg.root_dir / "mcpm.lock") as f:
         lock_dict = json.loads(f.read())
         return common.LockRecord.from_dict(lock_dict)
 
-def update_lock(cfg, lock_record):
+
+def get_lock(cfg):
+    lock = read_lock(cfg)
+    if lock is None:
+        return new_lock(cfg)
+    return lock
+
+
+def get_frozen_lock(cfg):
+    lock_record = read_lock(cfg)
+    if lock_record is None:
+        raise common.McpmError("There is no mcpm.lock to provision from. Run 'mcpm lock' first.")
+    if is_lock_current(cfg, lock_record):
+        return lock_record
+    check_lock(cfg, lock_record)
+    plugin_names = { plugin.name for plugin in cfg.plugins }
+    missing = sorted(plugin.name for plugin in pending_plugins(cfg, lock_record))
+    extra = sorted(
+            plugin.name for plugin in lock_record.plugins
+            if plugin.name not in plugin_names and not plugin.required_by
+        )
+    if lock_record.server is None or missing or extra:
+        msg = "The mcpm.lock is out of date with mcpm.toml."
+        if missing:
+            msg += os.linesep + f"Not locked: {', '.join(missing)}."
+        if extra:
+            msg += os.linesep + f"Locked but not in mcpm.toml: {', '.join(extra)}."
+        msg += os.linesep + "Run 'mcpm lock' to update it."
+        raise common.McpmError(msg)
+    return lock_record
+
+
+def check_lock(cfg, lock_record):
     if cfg.loader != lock_record.loader:
         msg = f"The mcpm.lock uses loader '{lock_record.loader}', but mcpm.toml specifies loader '{cfg.loader}'."
         msg += os.linesep + "Please delete mcpm.lock in order to switch loaders."
@@ -165,19 +254,123 @@ def update_lock(cfg, lock_record):
         msg = f"The mcpm.lock uses Minecraft {lock_record.game_version}, but mcpm.toml specifies version {cfg.version}."
         msg += os.linesep + "Please delete mcpm.lock in order to switch game versions."
         raise common.McpmError(msg)
-    if lock_record.server is None:
-        lock_record.server = api.get_server_version(lock_record.loader, lock_record.game_version)
-    for plugin in cfg.plugins:
-        if lock_record.find_plugin(plugin.name) is None:
-            plugin_version = api.get_plugin_version(
-                    plugin.name, plugin.source, plugin.channel,
-                    lock_record.loader, lock_record.game_version
+
+
+def pending_plugins(cfg, lock_record):
+    return [
+        plugin for plugin in cfg.plugins
+        if lock_record.find_plugin(plugin.name) is None
+    ]
+
+
+async def _aget_project_names(wanted):
+    refs = {}
+    for source, ref in wanted:
+        refs.setdefault(source, set()).add(ref)
+    found = await asyncio.gather(*(api.aget_project_names(source, names) for source, names in refs.items()))
+    return {
+        (source, ref): name
+        for source, names in zip(refs, found) for ref, name in names.items()
+    }
+
+
+async def alock_dependencies(cfg, lock_record, workers=None):
+    # walks the dependency graph one level at a time: everything a level needs
+    # that isn't locked yet is resolved together, then becomes the next level
+    direct = { plugin.name for plugin in cfg.plugins }
+    seen = None
+    required_by = {}
+    level = [ plugin for plugin in lock_record.plugins if plugin.name in direct ]
+    while level:
+        wanted = {}
+        for plugin in level:
+            for dependency in plugin.dependencies:
+                wanted.setdefault((plugin.source, dependency), []).append(plugin.name)
+        if not wanted:
+            break
+        refs = list(wanted)
+        if seen is None:
+            # mcpm.toml may name a plugin by id or in another case, compare
+            # direct plugins by the same canonical name dependencies get
+            refs += [ (plugin.source, plugin.name) for plugin in level ]
+        names = await _aget_project_names(refs)
+        if seen is None:
+            seen = { names[(plugin.source, plugin.name)] for plugin in level }
+        level = []
+        queries = []
+        for key, requirers in wanted.items():
+            name = names[key]
+            required_by.setdefault(name, set()).update(requirers)
+            if name in seen:
+                continue # the lock holds one entry per name, whichever source asked for it first
+            seen.add(name)
+            locked = lock_record.find_plugin(name)
+            if locked is not None:
+                level.append(locked)
+            else:
+                queries.append((name, key[0], None))
+        if queries:
+            plugin_versions = await api.aresolve_plugins(
+                    queries, lock_record.loader, lock_record.game_version, workers
                 )
-            lock_record.add_plugin(plugin_version)
-    lock_record.remove_plugins_except([
-        plugin.name for plugin in cfg.plugins
-    ])
+            for plugin_version in plugin_versions:
+                lock_record.add_plugin(plugin_version)
+            level += plugin_versions
+    for plugin in lock_record.plugins:
+        plugin.required_by = [] if plugin.name in direct else sorted(required_by.get(plugin.name, ()))
+
+
+def lock_dependencies(cfg, lock_record, workers=None):
+    common.run(alock_dependencies(cfg, lock_record, workers), workers)
+
+
+def prune_lock(cfg, lock_record):
+    # keeps what mcpm.toml lists, then whatever that requires
+    plugin_names = [ plugin.name for plugin in cfg.plugins ]
+    plugin_names += [ plugin.name for plugin in lock_record.plugins if plugin.required_by ]
+    lock_record.remove_plugins_except(plugin_names)
+    lock_record.sort_plugins(plugin_names)
+
+
+def finish_lock(cfg, lock_record, plugin_versions=()):
+    for plugin_version in plugin_versions:
+        lock_record.add_plugin(plugin_version)
+    prune_lock(cfg, lock_record)
+    lock_record.fingerprint = get_fingerprint(cfg)
+
+
+async def aupdate_lock(cfg, lock_record, workers=None):
+    check_lock(cfg, lock_record)
+    pending = pending_plugins(cfg, lock_record)
+    plugin_versions = api.aresolve_plugins(
+            [ (plugin.name, plugin.source, plugin.channel) for plugin in pending ],
+            lock_record.loader, lock_record.game_version, workers
+        )
+    if lock_record.server is None:
+        lock_record.server, plugin_versions = await asyncio.gather(
+                api.aget_server_version(lock_record.loader, lock_record.game_version),
+                plugin_versions
+            )
+    else:
+        plugin_versions = await plugin_versions
+    for plugin_version in plugin_versions:
+        lock_record.add_plugin(plugin_version)
+    await alock_dependencies(cfg, lock_record, workers)
+    finish_lock(cfg, lock_record)
+
+
+def update_lock(cfg, lock_record, workers=None):
+    common.run(aupdate_lock(cfg, lock_record, workers), workers)
 
 def write_lock(cfg, lock):
-    with open(cfg.root_dir / "mcpm.lock", "w") as f:
-        f.write(json.dumps(lock.to_dict(), indent=2))
+    path = cfg.root_dir / "mcpm.lock"
+    content = json.dumps(lock.to_dict(), indent=2)
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False # leave the file (and its mtime) alone
+    except FileNotFoundError:
+        pass
+    with open(path, "w") as f:
+        f.write(content)
+    return True
@@ -0,0 +1,309 @@
+import asyncio
+import collections
+import os
+import mcpm.api as api
+import mcpm.common as common
+import mcpm.config as config
+import mcpm.manifest as manifest
+import mcpm.provision as provision
+
+
+OUTDATED_LISTED = 5 # per workspace in the summary, --json has them all
+
+
+class Workspace:
+
+    def __init__(self, root_dir):
+        self._root_dir = root_dir
+        self.cfg = None
+        self.lock = None
+        self.error = None
+        self.summary = None
+        self.outdated = None
+
+    @property
+    def root_dir(self):
+        return self._root_dir
+
+
+def find_workspaces(root_dir):
+    return [ Workspace(path) for path in config.find_workspaces(root_dir) ]
+
+
+def _memoize(memo, key, factory):
+    if key not in memo:
+        memo[key] = asyncio.ensure_future(factory())
+    return memo[key]
+
+
+async def _each(workspaces, func):
+    active = [ ws for ws in workspaces if ws.error is None ]
+    results = await asyncio.gather(*(func(ws) for ws in active), return_exceptions=True)
+    for ws, result in zip(active, results):
+        if isinstance(result, Exception):
+            ws.error = result
+
+
+async def _aload(workspaces, new=False):
+    latest = {}
+
+    async def load(ws):
+        ws.cfg = config.get_config(ws.root_dir, readonly=True)
+        ws.lock = None if new else config.read_lock(ws.cfg)
+        if ws.lock is None:
+            loader = ws.cfg.loader
+            game_version = ws.cfg.version
+            if game_version == "latest":
+                game_version = await _memoize(latest, loader, lambda: api.aget_latest_game_version(loader))
+            ws.lock = common.LockRecord(loader, game_version)
+        config.check_lock(ws.cfg, ws.lock)
+
+    await _each(workspaces, load)
+
+
+async def _aresolve_servers(workspaces, only_missing):
+    memo = {}
+
+    async def resolve(ws):
+        if only_missing and ws.lock.server is not None:
+            return
+        key = (ws.lock.loader, ws.lock.game_version)
+        ws.lock.server = await _memoize(memo, key, lambda: api.aget_server_version(*key))
+
+    await _each(workspaces, resolve)
+
+
+async def _aresolve_plugins(workspaces, wanted, workers, return_exceptions=False):
+    # identical (name, source, channel) queries against the same loader and game
+    # version are resolved once for the whole fleet
+    groups = collections.defaultdict(dict)
+    for ws, queries in wanted.items():
+        group = groups[(ws.lock.loader, ws.lock.game_version)]
+        for name, source, channel, current in queries:
+            group.setdefault((name, source, channel), current)
+    resolved = {}
+
+    async def resolve(key, group):
+        queries = list(group)
+        versions = await api.aresolve_plugins(
+                queries, *key, workers,
+                current=[ group[query] for query in queries ],
+                return_exceptions=True
+            )
+        for query, version in zip(queries, versions):
+            resolved[key + query] = version
+
+    await asyncio.gather(*(resolve(key, group) for key, group in groups.items()))
+    results = {}
+    for ws, queries in wanted.items():
+        key = (ws.lock.loader, ws.lock.game_version)
+        versions = [ resolved[key + query[:3]] for query in queries ]
+        if return_exceptions:
+            results[ws] = versions
+            continue
+        errors = [
+            (query[0], version) for query, version in zip(queries, versions)
+            if isinstance(version, Exception)
+        ]
+        if errors:
+            ws.error = common.ResolutionError(errors)
+        else:
+            results[ws] = versions
+    return results
+
+
+async def alock(workspaces, workers=None, new=False):
+    await _aload(workspaces, new)
+    active = [ ws for ws in workspaces if ws.error is None ]
+    wanted = {
+        ws: [
+            (plugin.name, plugin.source, plugin.channel, None)
+            for plugin in config.pending_plugins(ws.cfg, ws.lock)
+        ]
+        for ws in active
+    }
+    _, resolved = await asyncio.gather(
+            _aresolve_servers(active, only_missing=True),
+            _aresolve_plugins(active, wanted, workers)
+        )
+    for ws in active:
+        if ws.error is None:
+            for plugin_version in resolved[ws]:
+                ws.lock.add_plugin(plugin_version)
+    await _each(active, lambda ws: config.alock_dependencies(ws.cfg, ws.lock, workers))
+    for ws in active:
+        if ws.error is not None:
+            continue
+        config.finish_lock(ws.cfg, ws.lock)
+        config.write_lock(ws.cfg, ws.lock)
+        ws.summary = f'{len(resolved[ws])} plugin(s) newly locked, {len(ws.lock.plugins)} total'
+
+
+async def aupgrade(workspaces, workers=None, target='all', plugins=()):
+    if target == 'full':
+        await alock(workspaces, workers, new=True)
+        return
+    await _aload(workspaces)
+    active = [ ws for ws in workspaces if ws.error is None ]
+    old_servers = { ws: ws.lock.server for ws in active }
+    wanted = {}
+    for ws in active:
+        if plugins:
+            locked = [ ws.lock.find_plugin(name) for name in plugins ]
+        else:
+            locked = list(ws.lock.plugins)
+        wanted[ws] = [
+            (ver.name, ver.source, ver.channel, ver)
+            for ver in locked if ver is not None
+        ]
+    await _aresolve_servers(active, only_missing=target not in ('server', 'all'))
+    if target in ('plugins', 'all'):
+        resolved = await _aresolve_plugins(active, wanted, workers)
+    else:
+        resolved = {}
+    changes = {}
+    for ws in active:
+        if ws.error is not None:
+            continue
+        changes[ws] = 0
+        for query, new_ver in zip(wanted[ws], resolved.get(ws, [])):
+            old_ver = query[3]
+            changes[ws] += old_ver.version != new_ver.version
+            ws.lock.replace_plugin(old_ver, new_ver)
+    if resolved:
+        await _each(active, lambda ws: config.alock_dependencies(ws.cfg, ws.lock, workers))
+    for ws in active:
+        if ws.error is not None:
+            continue
+        if resolved:
+            config.prune_lock(ws.cfg, ws.lock)
+        changed = changes[ws]
+        server = ''
+        if old_servers[ws] is None or ws.lock.server.version != old_servers[ws].version:
+            server = f', server now {ws.lock.server.version}'
+        config.write_lock(ws.cfg, ws.lock)
+        ws.summary = f'{changed} plugin(s) upgraded{server}'
+
+
+async def _afreeze(workspaces):
+
+    async def load(ws):
+        ws.cfg = config.get_config(ws.root_dir, readonly=True)
+        ws.lock = config.get_frozen_lock(ws.cfg)
+
+    await _each(workspaces, load)
+
+
+async def aprovision(workspaces, workers=None, host_workers=provision.DEFAULT_HOST_WORKERS,
+                     store=None, verify=False, frozen=False, bundle=None, stale='remove'):
+    if workers is None:
+        workers = common.DEFAULT_WORKERS
+    if frozen:
+        await _afreeze(workspaces)
+    else:
+        await alock(workspaces, workers)
+    active = [ ws for ws in workspaces if ws.error is None ]
+    unstaged = {}
+    for ws in active:
+        paths = provision.job_paths(provision.provision_jobs(ws.lock, ws.root_dir))
+        unstaged[ws] = provision.unstage(ws.root_dir, paths)
+    states = { ws: manifest.get_manifest(ws.root_dir) for ws in active }
+    jobs = [
+        (download, dir, states[ws])
+        for ws in active
+        for pkg_lock, dir in provision.provision_jobs(ws.lock, ws.root_dir)
+        for download in pkg_lock.downloads
+    ]
+    # one scheduler for the whole fleet, identical jars are fetched once through the store
+    progress = provision.DownloadProgress(len(jobs))
+    scheduler = provision.DownloadScheduler(workers, host_workers, progress, store, verify, bundle)
+    try:
+        results = await scheduler.arun(jobs, return_exceptions=True)
+    finally:
+        for state in states.values():
+            manifest.write_manifest(state)
+    for ws in active:
+        statuses = {
+            path: status for path, status in results.items()
+            if path.parent in (ws.root_dir, ws.root_dir / 'plugins')
+        }
+        errors = [
+            (path.name, status) for path, status in statuses.items()
+            if isinstance(status, Exception)
+        ]
+        if errors:
+            ws.error = common.DownloadError(errors)
+            continue
+        pruned = provision.prune(states[ws], set(statuses), stale)
+        if pruned:
+            manifest.write_manifest(states[ws])
+            statuses.update(pruned)
+        statuses.update(unstaged[ws])
+        counts = collections.Counter(statuses.values())
+        ws.summary = ', '.join(f'{n} {status}' for status, n in sorted(counts.items()))
+
+
+async def aoutdated(workspaces, workers=None):
+
+    async def load(ws):
+        ws.cfg = config.get_config(ws.root_dir, readonly=True)
+        ws.lock = config.read_lock(ws.cfg)
+        if ws.lock is None:
+            raise common.McpmError("There is no mcpm.lock to compare against. Run 'mcpm lock' first.")
+
+    await _each(workspaces, load)
+    active = [ ws for ws in workspaces if ws.error is None ]
+    wanted = {
+        ws: [ (ver.name, ver.source, ver.channel, ver) for ver in ws.lock.plugins ]
+        for ws in active
+    }
+    memo = {}
+
+    async def resolve_server(ws):
+        key = (ws.lock.loader, ws.lock.game_version)
+        try:
+            return await _memoize(memo, key, lambda: api.aget_server_version(*key))
+        except Exception as e:
+            return e # reported in the entry, like plugin errors
+
+    servers, resolved = await asyncio.gather(
+            asyncio.gather(*(resolve_server(ws) for ws in active)),
+            _aresolve_plugins(active, wanted, workers, return_exceptions=True)
+        )
+    for ws, server in zip(active, servers):
+        pairs = [ (query[3], version) for query, version in zip(wanted[ws], resolved[ws]) ]
+        if ws.lock.server is not None:
+            pairs.insert(0, (ws.lock.server, server))
+        ws.outdated = [ api.outdated_entry(locked, latest) for locked, latest in pairs ]
+        names = [
+            f"{entry['name']} {entry['current']} -> {entry['latest']}"
+            for entry in ws.outdated if entry['outdated']
+        ]
+        failed = sum('error' in entry for entry in ws.outdated)
+        ws.summary = f'{len(names)} of {len(ws.outdated)} outdated'
+        if failed:
+            ws.summary += f', {failed} could not be checked'
+        if names:
+            more = f', {len(names) - OUTDATED_LISTED} more' if len(names) > OUTDATED_LISTED else ''
+            ws.summary += f" ({', '.join(names[:OUTDATED_LISTED])}{more})"
+
+
+def outdated_report(workspaces, root_dir):
+    report = {}
+    for ws in workspaces:
+        name = ws.root_dir.relative_to(root_dir).as_posix()
+        report[name] = { 'error': str(ws.error) } if ws.error is not None else ws.outdated
+    return report
+
+
+def print_summary(workspaces, root_dir):
+    for ws in workspaces:
+        name = ws.root_dir.relative_to(root_dir).as_posix()
+        if ws.error is not None:
+            error = str(ws.error).replace(os.linesep, os.linesep + '    ')
+            print(f'{name}: error: {error}')
+        else:
+            print(f'{name}: {ws.summary}')
+    failed = sum(ws.error is not None for ws in workspaces)
+    print(f'{len(workspaces)} workspace(s), {failed} failed.')
+    return failed
@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import time
+import mcpm.common as common
+import mcpm.manifest as manifest
+import mcpm.provision as provision
+
+
+# A staged provision builds the complete jar set in .mcpm/generations/<n>
+# while the server keeps running, so that activating it is only a matter of
+# links: .mcpm/current is flipped to the generation, and the jars in the
+# server directory are symlinks through .mcpm/current. Jar names carry their
+# version, so most upgraded jars are new links created (and their old ones
+# removed) one by one right after the flip, not atomically with it. The
+# previous generation stays around for rollback, and a plain provision turns
+# the links back into regular files (provision.unstage).
+
+GENERATIONS_DIR = 'generations'
+CURRENT_LINK = common.CURRENT_LINK
+INDEX_FILE = 'generation.json'
+
+
+def _generations_dir(root_dir):
+    return root_dir / common.STATE_DIR / GENERATIONS_DIR
+
+
+def _current_link(root_dir):
+    return root_dir / common.STATE_DIR / CURRENT_LINK
+
+
+def list_generations(root_dir):
+    try:
+        names = os.listdir(_generations_dir(root_dir))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def get_current(root_dir):
+    try:
+        target = os.readlink(_current_link(root_dir))
+    except (FileNotFoundError, OSError):
+        return None
+    name = os.path.basename(target)
+    return int(name) if name.isdigit() else None
+
+
+def _read_index(gen_dir):
+    try:
+        with open(gen_dir / INDEX_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _seed(state, jobs, previous):
+    # jars the previous generation already has are hardlinked instead of fetched again
+    if previous is None:
+        return
+    index = _read_index(previous)
+    if index is None:
+        return
+    known = index['files']
+    for pkg_lock, dir in jobs:
+        for download in pkg_lock.downloads:
+            path = dir / download.filename
+            key = path.relative_to(state.root_dir).as_posix()
+            if key not in known or known[key]['checksums'] != download.checksums:
+                continue
+            try:
+                os.link(previous / key, path)
+            except OSError:
+                continue
+            state.record(path, download.checksums)
+
+
+async def astage(lock, root_dir, workers=None, host_workers=provision.DEFAULT_HOST_WORKERS,
+                 store=None, bundle=None):
+    if workers is None:
+        workers = common.DEFAULT_WORKERS
+    generations = list_generations(root_dir)
+    number = generations[-1] + 1 if generations else 1
+    gens_dir = _generations_dir(root_dir)
+    gens_dir.mkdir(parents=True, exist_ok=True)
+    # half-built generations never show up under their number
+    tmp = gens_dir / f'.{number}.{os.getpid()}.tmp'
+    tmp.mkdir()
+    try:
+        jobs = provision.provision_jobs(lock, tmp)
+        state = manifest.Manifest(tmp)
+        current = get_current(root_dir)
+        _seed(state, jobs, gens_dir / str(current) if current is not None else None)
+        results = await provision.adownload_packages(
+                jobs, workers, host_workers, store=store, manifest=state, bundle=bundle
+            )
+        index = {
+            'created': time.time(),
+            'loader': lock.loader,
+            'game_version': lock.game_version,
+            'server': lock.server.version,
+            **state.to_dict(),
+        }
+        with open(tmp / INDEX_FILE, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.rename(tmp, gens_dir / str(number))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return number, results
+
+
+def stage(lock, root_dir, workers=None, host_workers=provision.DEFAULT_HOST_WORKERS,
+          store=None, bundle=None):
+    coro = astage(lock, root_dir, workers, host_workers, store, bundle)
+    return common.run(coro, workers)
+
+
+def _replace_symlink(target, path):
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    tmp.unlink(missing_ok=True)
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
+
+def activate(root_dir, number, stale='remove'):
+    gen_dir = _generations_dir(root_dir) / str(number)
+    index = _read_index(gen_dir)
+    if index is None:
+        raise common.McpmError(f'Generation {number} does not exist or is incomplete.')
+    current = _current_link(root_dir)
+    _replace_symlink(os.path.join(GENERATIONS_DIR, str(number)), current)
+    files = { root_dir / key for key in index['files'] }
+    results = {}
+    for path in sorted(files):
+        path.parent.mkdir(exist_ok=True)
+        if not provision.is_staged_link(path, root_dir):
+            _replace_symlink(os.path.relpath(current / path.relative_to(root_dir), path.parent), path)
+            results[path] = 'linked'
+    for dir in (root_dir, root_dir / 'plugins'):
+        for path in dir.iterdir() if dir.is_dir() else ():
+            if path not in files and provision.is_staged_link(path, root_dir):
+                path.unlink()
+                results[path] = 'unlinked'
+    # jars an unstaged provision left in place are pruned as usual, then the
+    # manifest forgets the links, they belong to the generation
+    state = manifest.get_manifest(root_dir)
+    results.update(provision.prune(state, files, stale))
+    for path in files:
+        state.forget(path)
+    manifest.write_manifest(state)
+    return results
+
+
+def prune_generations(root_dir):
+    # keeps the live generation, the one before it (for rollback), and anything newer
+    current = get_current(root_dir)
+    if current is None:
+        return []
+    older = [ number for number in list_generations(root_dir) if number < current ]
+    removed = older[:-1]
+    for number in removed:
+        shutil.rmtree(_generations_dir(root_dir) / str(number), ignore_errors=True)
+    return removed
+
+
+def rollback(root_dir, stale='remove'):
+    current = get_current(root_dir)
+    if current is None:
+        raise common.McpmError("Nothing to roll back, no staged generation is live. Use 'mcpm provision --staged'.")
+    older = [ number for number in list_generations(root_dir) if number < current ]
+    if not older:
+        raise common.McpmError(f'Generation {current} is the oldest one left, there is nothing to roll back to.')
+    results = activate(root_dir, older[-1], stale)
+    return older[-1], results
@@ -1,47 +1,99 @@
-import urllib.request
-import json
+import asyncio
+import os
 import mcpm.common as common
+import mcpm.cache as cache
+import mcpm.client as client
 
 GEYSER_API_VERSION = "v2"
-GEYSER_API_BASE_URL = f"https://download.geysermc.org/{GEYSER_API_VERSION}"
+GEYSER_API_BASE_URL = os.environ.get('MCPM_GEYSER_API_URL', f"https://download.geysermc.org/{GEYSER_API_VERSION}")
+
+class GeyserApiError(common.ApiError):
+    pass
+
+def _check_error(results, key, url):
+    # error responses come back from the cache as data like any other
+    if not isinstance(results, dict) or key not in results:
+        if isinstance(results, dict) and "error" in results:
+            raise GeyserApiError(f'The Geyser API returned an error for {url}: {results["error"]}')
+        raise GeyserApiError(f'An unknown error occurred. {url} returned no "{key}".')
+    return results
 
 def _get_project_versions(project_name):
     url = GEYSER_API_BASE_URL
     url += f'/projects/{project_name}'
-    with urllib.request.urlopen(url) as response:
-        results = json.loads(response.read())
-        return results["versions"]
+    results = _check_error(cache.get_json(url), "versions", url)
+    return results["versions"]
 
 def _get_build_versions(project_name, project_version):
     url = GEYSER_API_BASE_URL
     url += f'/projects/{project_name}/versions/{project_version}'
-    with urllib.request.urlopen(url) as response:
-        results = json.loads(response.read())
-        return results["builds"]
+    results = _check_error(cache.get_json(url), "builds", url)
+    return results["builds"]
 
-def _get_build_info(project_name, project_version, build_version, server_type):
+def _get_build_url(project_name, project_version, build_version):
     url = GEYSER_API_BASE_URL
     url += f'/projects/{project_name}/versions/{project_version}/builds/{build_version}'
-    with urllib.request.urlopen(url) as response:
-        results = json.loads(response.read())
-        record = results["downloads"][server_type]
-        name = record.pop("name")
-        return name, record
+    return url
+
+def _get_build_info(project_name, project_version, build_version):
+    # a published build never changes, no need to ever ask again
+    url = _get_build_url(project_name, project_version, build_version)
+    return _check_error(cache.get_json(url, immutable=True), "downloads", url)
+
+def _get_latest_build_info(project_name):
+    url = GEYSER_API_BASE_URL
+    url += f'/projects/{project_name}/versions/latest/builds/latest'
+    try:
+        results = cache.get_json(url)
+    except (client.HttpStatusError, ValueError):
+        return None
+    if not isinstance(results, dict) or "downloads" not in results:
+        return None
+    # "latest" moves on, the concrete build it points at doesn't
+    url = _get_build_url(project_name, results["version"], results["build"])
+    cache.put_json(url, results, immutable=True)
+    return results
+
+def _get_download(build_info, server_type):
+    if server_type not in build_info["downloads"]:
+        raise GeyserApiError(f'There is no {server_type} download in this build.')
+    record = dict(build_info["downloads"][server_type])
+    name = record.pop("name")
+    return name, record
 
 def get_default_channel():
     return 'default'
 
-def iter_plugin_versions(plugin_name, loader, game_version, channel):
+def _get_plugin_version(plugin_name, loader, channel):
     if loader == "paper":
         loader = "spigot"
-    proj_ver = _get_project_versions(plugin_name)[-1]
-    build_ver = _get_build_versions(plugin_name, proj_ver)[-1]
-    filename, checksums = _get_build_info(plugin_name, proj_ver, build_ver, loader)
+    # one round trip when the server supports "latest", three otherwise
+    build_info = _get_latest_build_info(plugin_name)
+    if build_info is not None:
+        proj_ver = build_info["version"]
+        build_ver = build_info["build"]
+    else:
+        proj_ver = _get_project_versions(plugin_name)[-1]
+        build_ver = _get_build_versions(plugin_name, proj_ver)[-1]
+        build_info = _get_build_info(plugin_name, proj_ver, build_ver)
+    filename, checksums = _get_download(build_info, loader)
     url = f"{GEYSER_API_BASE_URL}/projects/{plugin_name}/versions/{proj_ver}/builds/{build_ver}/downloads/{loader}"
     full_version = f'{proj_ver}-{build_ver}'
     idx = filename.rfind('.')
     filename = filename[:idx] + f'-{full_version}' + filename[idx:]
     downloads = [ common.DownloadRecord(url, filename, checksums) ]
-    versions = [ common.VersionRecord(plugin_name, 'geyser', full_version, channel, downloads) ]
-    for version in versions:
-        yield version
+    return common.VersionRecord(plugin_name, 'geyser', full_version, channel, downloads)
+
+def iter_plugin_versions(plugin_name, loader, game_version, channel):
+    yield _get_plugin_version(plugin_name, loader, channel)
+
+async def aresolve_plugins(queries, loader, game_version):
+    # geyser, floodgate & co. are independent projects, ask for all of them at once
+    versions = await asyncio.gather(
+            *(common.to_thread(_get_plugin_version, name, loader, channel) for name, channel, current in queries),
+            return_exceptions=True
+        )
+    return {
+        i: version for i, version in enumerate(versions)
+        if not isinstance(version, Exception)
+    }
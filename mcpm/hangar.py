@@ -1,19 +1,24 @@
-import urllib.request
-import json
+import concurrent.futures
+import os
 import mcpm.common as common
+import mcpm.cache as cache
 
 
 HANGAR_API_VERSION = "v1"
-HANGAR_API_BASE_URL = f"https://hangar.papermc.io/api/{HANGAR_API_VERSION}"
+HANGAR_API_BASE_URL = os.environ.get('MCPM_HANGAR_API_URL', f"https://hangar.papermc.io/api/{HANGAR_API_VERSION}")
+HANGAR_PAGE_SIZE = 25
 
 
 class HangarApiError(common.ApiError):
     pass
 
 
-def _get_versions_api_url(name, loader, game_version, channel):
+_prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=common.DEFAULT_WORKERS)
+
+
+def _get_versions_api_url(name, loader, game_version, channel, offset=0, limit=HANGAR_PAGE_SIZE):
     url = HANGAR_API_BASE_URL
-    url += f'/projects/{name}/versions?'
+    url += f'/projects/{name}/versions?limit={limit}&offset={offset}&'
     if loader is not None:
         url += f'platform={loader}&'
     if game_version is not None:
@@ -30,24 +35,46 @@ def _make_version_record(result, name, loader):
         for k, v in dl["fileInfo"].items()
         if k.endswith("Hash")
     }
-    downloads = [ common.DownloadRecord(dl["downloadUrl"], dl["fileInfo"]["name"], dl_hashes) ]
-    return common.VersionRecord(name, 'hangar', result["name"], result["channel"]["name"], downloads)
+    downloads = [ common.DownloadRecord(dl["downloadUrl"], dl["fileInfo"]["name"], dl_hashes, dl["fileInfo"].get("sizeBytes")) ]
+    # external dependencies (no hangar project behind them) can't be locked
+    dependencies = [
+            dependency["name"] for dependency in result.get("pluginDependencies", {}).get(loader.upper(), [])
+            if dependency.get("required") and not dependency.get("externalUrl")
+        ]
+    return common.VersionRecord(name, 'hangar', result["name"], result["channel"]["name"], downloads, dependencies)
 
 
 def get_default_channel():
     return 'release'
 
 
-def iter_plugin_versions(plugin_name, loader, game_version, channel):
-    url = _get_versions_api_url(plugin_name, loader, game_version, channel)
-    with urllib.request.urlopen(url) as response:
-        results = json.loads(response.read())
+def _get_page(url):
+    results = cache.get_json(url)
     if "httpError" in results:
         msg = f'The Hangar API returned an error ({results["httpError"]["statusCode"]}): {results["message"]}'
         raise HangarApiError(msg)
     if "result" not in results:
         raise HangarApiError('An unknown error occurred. Json structure unrecognized.')
-    assert results["pagination"]["limit"] > results["pagination"]["count"] # i'll deal with pagination later
-    results = results["result"]
-    for result in results:
-        yield _make_version_record(result, plugin_name, loader)
\ No newline at end of file
+    return results
+
+
+def iter_plugin_versions(plugin_name, loader, game_version, channel, page_size=HANGAR_PAGE_SIZE):
+    def page_url(offset):
+        return _get_versions_api_url(plugin_name, loader, game_version, channel, offset, page_size)
+
+    offset = 0
+    page = _get_page(page_url(offset))
+    while True:
+        results = page["result"]
+        next_offset = offset + len(results)
+        has_more = len(results) > 0 and next_offset < page["pagination"]["count"]
+        prefetch = None
+        for i, result in enumerate(results):
+            # the caller wants more than the first version, fetch the next page in the background
+            if i > 0 and has_more and prefetch is None:
+                prefetch = _prefetcher.submit(_get_page, page_url(next_offset))
+            yield _make_version_record(result, plugin_name, loader)
+        if not has_more:
+            return
+        page = prefetch.result() if prefetch is not None else _get_page(page_url(next_offset))
+        offset = next_offset
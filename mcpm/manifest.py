@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import threading
+import mcpm.common as common
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def _signature(st):
+    return {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'inode': st.st_ino,
+    }
+
+
+class Manifest:
+
+    def __init__(self, root_dir, files=None):
+        self._root_dir = root_dir
+        self._files = files if files is not None else {}
+        self._lock = threading.Lock()
+
+    @property
+    def root_dir(self):
+        return self._root_dir
+
+    @property
+    def files(self):
+        return self._files
+
+    def _key(self, path):
+        return path.relative_to(self._root_dir).as_posix()
+
+    def is_verified(self, path, checksums):
+        entry = self._files.get(self._key(path))
+        if entry is None or entry['checksums'] != checksums:
+            return False
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return False
+        return entry['stat'] == _signature(st)
+
+    def record(self, path, checksums):
+        entry = {
+            'stat': _signature(path.stat()),
+            'checksums': checksums,
+        }
+        with self._lock:
+            self._files[self._key(path)] = entry
+
+    def forget(self, path):
+        with self._lock:
+            self._files.pop(self._key(path), None)
+
+    def to_dict(self):
+        return { 'files': self._files }
+
+    @staticmethod
+    def from_dict(root_dir, value):
+        return Manifest(root_dir, value.get('files', {}))
+
+
+def get_manifest(root_dir):
+    try:
+        with open(root_dir / common.STATE_DIR / MANIFEST_FILE) as f:
+            return Manifest.from_dict(root_dir, json.load(f))
+    except (OSError, ValueError):
+        return Manifest(root_dir)
+
+
+def write_manifest(manifest):
+    state_dir = manifest.root_dir / common.STATE_DIR
+    state_dir.mkdir(exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=state_dir, suffix='.tmp', delete=False) as f:
+        json.dump(manifest.to_dict(), f, indent=2)
+    os.replace(f.name, state_dir / MANIFEST_FILE)
@@ -1,10 +1,19 @@
-import urllib.request
 import json
+import urllib.parse
+import os
+import threading
 import mcpm.common as common
+import mcpm.cache as cache
 
 
 MODRINTH_API_VERSION = "v2"
-MODRINTH_API_BASE_URL = f"https://api.modrinth.com/{MODRINTH_API_VERSION}"
+MODRINTH_API_BASE_URL = os.environ.get('MCPM_MODRINTH_API_URL', f"https://api.modrinth.com/{MODRINTH_API_VERSION}")
+MODRINTH_BATCH_SIZE = 100
+MODRINTH_HASH_ALGORITHMS = [ 'sha512', 'sha1' ]
+
+# every project /projects?ids= returned this run, by id and by lowercased slug
+_projects = {}
+_projects_lock = threading.Lock()
 
 
 class ModrinthApiError(common.ApiError):
@@ -25,10 +34,16 @@ def _get_versions_api_url(name, loader, game_version, channel):
 
 def _make_version_record(result, name):
     downloads = [
-            common.DownloadRecord(file["url"], file["filename"], file["hashes"])
+            common.DownloadRecord(file["url"], file["filename"], file["hashes"], file.get("size"))
             for file in result["files"] if file["primary"]
         ]
-    return common.VersionRecord(name, 'modrinth', result["version_number"], result["version_type"], downloads)
+    dependencies = [
+            dependency["project_id"] for dependency in result.get("dependencies", [])
+            if dependency.get("dependency_type") == "required" and dependency.get("project_id")
+        ]
+    return common.VersionRecord(
+            name, 'modrinth', result["version_number"], result["version_type"], downloads, dependencies
+        )
 
 
 def get_default_channel():
@@ -37,8 +52,7 @@ def get_default_channel():
 
 def iter_plugin_versions(plugin_name, loader, game_version, channel):
     url = _get_versions_api_url(plugin_name, loader, game_version, channel)
-    with urllib.request.urlopen(url) as response:
-        results = json.loads(response.read())
+    results = cache.get_json(url)
     if not isinstance(results, list):
         if "error" in results:
             msg = f'The Modrinth API returned an error ({results["error"]}): {results["description"]}'
@@ -47,3 +61,132 @@ def iter_plugin_versions(plugin_name, loader, game_version, channel):
             raise ModrinthApiError('An unknown error occurred. Results should be a list.')
     for result in results:
         yield _make_version_record(result, plugin_name)
+
+
+def _ids_param(ids):
+    return urllib.parse.quote(json.dumps(ids, separators=(',', ':')))
+
+
+def _expect(results, kind):
+    if not isinstance(results, kind):
+        if isinstance(results, dict) and "error" in results:
+            msg = f'The Modrinth API returned an error ({results["error"]}): {results["description"]}'
+            raise ModrinthApiError(msg)
+        raise ModrinthApiError(f'An unknown error occurred. Results should be a {kind.__name__}.')
+    return results
+
+
+def _find_project(ref):
+    with _projects_lock:
+        return _projects.get(ref) or _projects.get(ref.lower())
+
+
+def _get_projects(refs):
+    projects = []
+    for i in range(0, len(refs), MODRINTH_BATCH_SIZE):
+        chunk = refs[i:i + MODRINTH_BATCH_SIZE]
+        url = MODRINTH_API_BASE_URL + f'/projects?ids={_ids_param(chunk)}'
+        projects += _expect(cache.get_json(url), list)
+    with _projects_lock:
+        for project in projects:
+            _projects[project["id"]] = project
+            _projects[project["slug"].lower()] = project
+    return projects
+
+
+def get_project_names(refs):
+    # mcpm.toml and dependencies may refer to a project by id or by slug in any case, the lock uses the slug
+    _get_projects([ ref for ref in refs if _find_project(ref) is None ])
+    projects = { ref: _find_project(ref) for ref in refs }
+    return { ref: project["slug"] for ref, project in projects.items() if project is not None }
+
+
+def _get_versions(version_ids):
+    results = []
+    for i in range(0, len(version_ids), MODRINTH_BATCH_SIZE):
+        chunk = version_ids[i:i + MODRINTH_BATCH_SIZE]
+        url = MODRINTH_API_BASE_URL + f'/versions?ids={_ids_param(chunk)}'
+        results += _expect(cache.get_json(url), list)
+    return results
+
+
+def _get_hash(record):
+    for download in record.downloads:
+        for algo in MODRINTH_HASH_ALGORITHMS:
+            if algo in download.checksums:
+                return algo, download.checksums[algo]
+    return None
+
+
+def _resolve_updates(queries, loader, game_version):
+    by_request = {}
+    for i, (name, channel, current) in enumerate(queries):
+        if current is None or current.source != 'modrinth' or _get_hash(current) is None:
+            continue
+        algo, digest = _get_hash(current)
+        by_request.setdefault((algo, channel), {})[digest] = i
+    resolved = {}
+    for (algo, channel), hashes in by_request.items():
+        payload = {
+            'hashes': list(hashes),
+            'algorithm': algo,
+            'loaders': [ loader ],
+            'game_versions': [ str(game_version) ],
+            'version_types': [ channel ],
+        }
+        results = _expect(cache.post_json(MODRINTH_API_BASE_URL + '/version_files/update', payload), dict)
+        for digest, result in results.items():
+            if digest in hashes and result["version_type"] == channel:
+                i = hashes[digest]
+                resolved[i] = _make_version_record(result, queries[i][0])
+    return resolved
+
+
+def _resolve_projects(queries, loader, game_version):
+    names = sorted({ name for name, channel, current in queries })
+    _get_projects(names)
+    projects = { name: project for name in names if (project := _find_project(name)) is not None }
+    # batch the projects with the fewest versions, as many as still saves
+    # requests over asking for each one separately; the rest go one by one
+    found = sorted(
+            (i for i, query in enumerate(queries) if query[0] in projects),
+            key=lambda i: len(projects[queries[i][0]]["versions"])
+        )
+    wanted = []
+    total = 0
+    best = 0
+    for k, i in enumerate(found, 1):
+        total += len(projects[queries[i][0]]["versions"])
+        saved = k - -(-total // MODRINTH_BATCH_SIZE)
+        if saved > best:
+            best = saved
+            wanted = found[:k]
+    if not wanted:
+        return {} # not cheaper than asking for each project separately
+    version_ids = sorted({ v for i in wanted for v in projects[queries[i][0]]["versions"] })
+    candidates = {}
+    for version in _get_versions(version_ids):
+        if loader not in version["loaders"] or str(game_version) not in version["game_versions"]:
+            continue
+        candidates.setdefault(version["project_id"], []).append(version)
+    resolved = {}
+    for i in wanted:
+        name, channel, current = queries[i]
+        versions = [
+            version for version in candidates.get(projects[name]["id"], [])
+            if version["version_type"] == channel
+        ]
+        if versions:
+            latest = max(versions, key=lambda version: version["date_published"])
+            resolved[i] = _make_version_record(latest, name)
+    return resolved
+
+
+def resolve_plugins(queries, loader, game_version):
+    resolved = _resolve_updates(queries, loader, game_version)
+    pending = [ i for i in range(len(queries)) if i not in resolved ]
+    if len(pending) > 1:
+        projects = _resolve_projects([ queries[i] for i in pending ], loader, game_version)
+        for j, version in projects.items():
+            resolved[pending[j]] = version
+    return resolved
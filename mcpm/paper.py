@@ -1,48 +1,92 @@
-import urllib.request
-import json
+import os
+import time
 import mcpm.common as common
+import mcpm.cache as cache
+import mcpm.catalog as catalog
 
 
 PAPER_API_VERSION = "v3"
-PAPER_API_BASE_URL = f"https://fill.papermc.io/{PAPER_API_VERSION}"
+PAPER_API_BASE_URL = os.environ.get('MCPM_PAPER_API_URL', f"https://fill.papermc.io/{PAPER_API_VERSION}")
+BUILD_FETCH_LIMIT = 5 # past this many new builds, one full listing is cheaper than one request per build
+
+_process_start = time.time()
 
 
 class PaperApiError(common.ApiError):
     pass
 
 
-def get_latest_version(name):
+def _check_error(results, expected):
+    if not isinstance(results, expected):
+        if isinstance(results, dict) and "error" in results:
+            msg = f'The Paper API returned an error ({results["error"]}): {results.get("message")}'
+            raise PaperApiError(msg)
+        else:
+            raise PaperApiError(f'An unknown error occurred. Results should be a {expected.__name__}.')
+    return results
+
+
+def _is_stale(key):
+    # once per run; the http cache decides whether that costs a request
+    synced = catalog.get_catalog().synced_at(key)
+    return synced is None or synced < _process_start
+
+
+def _sync_versions(name):
+    if not _is_stale(name):
+        return
     url = PAPER_API_BASE_URL
     url += f'/projects/{name}/versions'
-    with urllib.request.urlopen(url) as response:
-        results = json.loads(response.read())
-    return results["versions"][0]["version"]["id"]
+    results = _check_error(cache.get_json(url), dict)
+    versions = [ (result["version"]["id"], result.get("builds")) for result in results["versions"] ]
+    catalog.get_catalog().set_versions(name, versions)
 
 
-def _get_versions_api_url(name, game_version, channel):
+def _make_build(result):
+    file = result["downloads"]["server:default"]
+    download = common.DownloadRecord(file["url"], file["name"], file["checksums"], file.get("size"))
+    return result["id"], result["channel"], download
+
+
+def _sync_builds(name, game_version):
+    if not _is_stale(f'{name}/{game_version}'):
+        return
+    _sync_versions(name)
+    index = catalog.get_catalog()
     url = PAPER_API_BASE_URL
-    url += f'/projects/{name}/versions/{game_version}/builds?'
-    if channel is not None:
-        url += f'channel={channel}&'
-    return url
+    url += f'/projects/{name}/versions/{game_version}/builds'
+    last = index.last_build(name, game_version)
+    build_ids = index.get_build_ids(name, game_version)
+    if last is not None and build_ids is not None:
+        new_ids = sorted(id for id in build_ids if id > last)
+        if len(new_ids) <= BUILD_FETCH_LIMIT:
+            # published builds never change
+            results = [ _check_error(cache.get_json(f'{url}/{id}', immutable=True), dict) for id in new_ids ]
+            index.add_builds(name, game_version, [ _make_build(result) for result in results ])
+            return
+    results = _check_error(cache.get_json(url), list)
+    builds = [ _make_build(result) for result in results if last is None or result["id"] > last ]
+    index.add_builds(name, game_version, builds)
 
 
-def _make_version_record(result, name, game_version):
-    file = result["downloads"]["server:default"]
-    downloads = [ common.DownloadRecord(file["url"], file["name"], file["checksums"]) ]
-    return common.VersionRecord(name, 'paper', f'{game_version}-{result["id"]}', result["channel"], downloads)
+def get_latest_version(name):
+    _sync_versions(name)
+    versions = catalog.get_catalog().get_versions(name)
+    if not versions:
+        raise PaperApiError(f'The Paper API lists no versions for {name}.')
+    return versions[0][0]
+
+
+def list_versions(name):
+    # (game version, latest build or None), newest first
+    _sync_versions(name)
+    return [
+        (version, max(build_ids) if build_ids else None)
+        for version, build_ids in catalog.get_catalog().get_versions(name)
+    ]
 
 
 def iter_server_versions(server_name, game_version):
-    channel = 'STABLE'
-    url = _get_versions_api_url(server_name, game_version, channel)
-    with urllib.request.urlopen(url) as response:
-        results = json.loads(response.read())
-    if not isinstance(results, list):
-        if "error" in results:
-            msg = f'The Paper API returned an error ({results["error"]}): {results["message"]}'
-            raise PaperApiError(msg)
-        else:
-            raise PaperApiError('An unknown error occurred. Results should be a list.')
-    for result in results:
-        yield _make_version_record(result, server_name, game_version)
+    _sync_builds(server_name, game_version)
+    for build, channel, download in catalog.get_catalog().get_builds(server_name, game_version, 'STABLE'):
+        yield common.VersionRecord(server_name, 'paper', f'{game_version}-{build}', channel, [ download ])
@@ -1,30 +1,439 @@
-import urllib.request
+import urllib.parse
 import hashlib
+import json
+import os
+import shutil
+import asyncio
+import threading
+import time
+import sys
+import mcpm.common as common
+import mcpm.client as client
+import mcpm.manifest as manifest
+import mcpm.store as store
+import mcpm.trace as trace
 
 
-def check_file(path, checksums):
-    with open(path, 'rb') as f:
-        for algo, true_digest in checksums.items():
-            if algo.lower() == "sha512":
-                continue # not sure why our sha512 hashes are wrong
-            actual_digest = hashlib.file_digest(f, algo.lower()).hexdigest()
-            assert actual_digest.lower() == true_digest.lower()
+DEFAULT_HOST_WORKERS = common.DEFAULT_HOST_WORKERS
+CHUNK_SIZE = 256 * 1024
+RESUME_ATTEMPTS = 3
+STALE_MODES = common.STALE_MODES
+QUARANTINE_DIR = 'quarantine'
 
 
-def download_package(pkg_lock, dir):
+class ChecksumError(common.McpmError):
+    pass
+
+
+def _usable_algorithms(name, checksums):
+    algos = [ algo for algo in checksums if algo.lower() in hashlib.algorithms_available ]
+    if not algos:
+        # unknown algorithms are skipped, but something has to vouch for the file
+        msg = f'{name} has no checksum mcpm can verify (got {", ".join(checksums) or "none"}).'
+        raise ChecksumError(msg)
+    return algos
+
+
+def _new_hashers(name, checksums):
+    return { algo: hashlib.new(algo.lower()) for algo in _usable_algorithms(name, checksums) }
+
+
+def _verify_hashers(name, hashers, checksums):
+    for algo, hasher in hashers.items():
+        actual_digest = hasher.hexdigest()
+        if actual_digest.lower() != checksums[algo].lower():
+            msg = f'The {algo} checksum of {name} is {actual_digest}, expected {checksums[algo]}.'
+            raise ChecksumError(msg)
+
+
+def _update_hashers(hashers, chunk):
+    for hasher in hashers.values():
+        hasher.update(chunk)
+
+
+def check_file(path, checksums, name=None):
+    hashers = _new_hashers(name or path.name, checksums)
+    with trace.span(name or path.name, 'hash') as span, open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            _update_hashers(hashers, chunk)
+            span.add('bytes', len(chunk))
+    _verify_hashers(name or path.name, hashers, checksums)
+
+
+def _load_part_meta(meta, url):
+    try:
+        with open(meta) as f:
+            value = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return value if value.get('url') == url else None
+
+
+def _write_part_meta(meta, url, validator):
+    with open(meta, 'w') as f:
+        json.dump({ 'url': url, 'validator': validator }, f)
+
+
+def _get_validator(headers):
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'): # If-Range needs a strong validator
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _download_part(download, f, meta, hashers, progress):
+    headers = { 'User-Agent': 'Mozilla/5.0' }
+    offset = f.tell()
+    state = _load_part_meta(meta, download.url)
+    if offset > 0:
+        headers['Range'] = f'bytes={offset}-'
+        if state is not None and state['validator']:
+            headers['If-Range'] = state['validator']
+    with client.get_client().get(download.url, headers=headers, decode=False) as conn:
+        conn.span.set(offset=offset)
+        if conn.status == 416 and offset > 0:
+            return # the part already holds the whole file, verification decides
+        conn.raise_for_status()
+        if conn.status != 206:
+            f.seek(0)
+            f.truncate()
+            for algo in hashers:
+                hashers[algo] = hashlib.new(algo.lower())
+        _write_part_meta(meta, download.url, _get_validator(conn.headers))
+        while chunk := conn.read(CHUNK_SIZE):
+            f.write(chunk)
+            _update_hashers(hashers, chunk)
+            if progress is not None:
+                progress.add_bytes(len(chunk))
+
+
+def _is_current(f, path):
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _download(download, dest, progress=None, readonly=False):
+    part = dest.with_name(dest.name + '.part')
+    meta = dest.with_name(dest.name + '.part.json')
+    while True:
+        with open(part, 'a+b') as f:
+            store.lock_file(f) # another mcpm process may be downloading the same artifact
+            if not _is_current(f, part):
+                continue # another process finished this part while we waited for the lock
+            if dest.is_file():
+                part.unlink()
+                return
+            hashers = _new_hashers(download.filename, download.checksums)
+            if _load_part_meta(meta, download.url) is None:
+                f.truncate(0)
+            f.seek(0)
+            while chunk := f.read(CHUNK_SIZE):
+                _update_hashers(hashers, chunk)
+            resumed = f.tell() > 0
+            for attempt in range(RESUME_ATTEMPTS):
+                try:
+                    _download_part(download, f, meta, hashers, progress)
+                    break
+                except client.RETRY_EXCEPTIONS:
+                    f.flush()
+                    if attempt + 1 == RESUME_ATTEMPTS:
+                        raise # keep the part, the next run resumes from it
+            f.flush()
+            try:
+                _verify_hashers(download.filename, hashers, download.checksums)
+            except ChecksumError:
+                part.unlink(missing_ok=True)
+                meta.unlink(missing_ok=True)
+                if resumed:
+                    continue # the old part may be what's corrupt, start over once
+                raise
+            store.move_into_place(part, dest, readonly)
+            meta.unlink(missing_ok=True)
+            return
+
+
+def _check_online(download, store):
+    if store is not None and store.offline:
+        raise common.McpmError(f'{download.filename} is not in the local artifact store and mcpm is offline.')
+
+
+def _obtain(download, dest, progress, store, bundle, readonly=False):
+    if bundle is not None:
+        bundle.extract(download, dest, progress, readonly)
+        return
+    _check_online(download, store)
+    _download(download, dest, progress, readonly)
+
+
+def _fetch_file(download, dir, progress=None, store=None, manifest=None, verify=False, bundle=None):
+    with trace.span(download.filename, 'fetch', url=download.url) as span:
+        status = _sync_file(download, dir, progress, store, manifest, verify, bundle)
+        span.set(status=status)
+        return status
+
+
+def _sync_file(download, dir, progress, store, manifest, verify, bundle):
+    path = dir / download.filename
+    _usable_algorithms(download.filename, download.checksums) # before anything on disk is touched
+    status = 'downloaded' if bundle is None else 'extracted'
+    if path.is_file():
+        if not verify and manifest is not None and manifest.is_verified(path, download.checksums):
+            return 'unchanged'
+        try:
+            check_file(path, download.checksums)
+            status = 'verified'
+        except ChecksumError:
+            if store is not None and store.has(download.checksums) and os.path.samefile(path, store.path(download.checksums)):
+                store.discard(download.checksums)
+            path.unlink()
+            status = 'repaired'
+    if status != 'verified':
+        if store is None or store.key(download.checksums) is None:
+            _obtain(download, path, progress, store, bundle)
+        else:
+            with store.lock(download.checksums):
+                if not store.has(download.checksums):
+                    obj = store.path(download.checksums)
+                    obj.parent.mkdir(parents=True, exist_ok=True)
+                    _obtain(download, obj, progress, store, bundle, readonly=True)
+                elif status != 'repaired':
+                    status = 'linked'
+            store.place(download.checksums, path)
+    if manifest is not None:
+        manifest.record(path, download.checksums)
+    return status
+
+
+def download_package(pkg_lock, dir, store=None):
     for download in pkg_lock.downloads:
-        if not (dir / download.filename).is_file():
-            req = urllib.request.Request(download.url, headers={'User-Agent': 'Mozilla/5.0'})
-            conn = urllib.request.urlopen(req)
-            with open(dir / download.filename, 'wb') as f:
-                f.write(conn.read())
-        check_file(dir / download.filename, download.checksums)
+        _fetch_file(download, dir, store=store)
+
+
+def format_size(n):
+    for unit in [ 'B', 'KiB', 'MiB' ]:
+        if n < 1024:
+            return f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} GiB'
 
 
-def provision(cfg, lock, dir=None):
+def parse_size(value):
+    units = { 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+    value = value.strip().lower().removesuffix('b').removesuffix('i')
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+    except ValueError:
+        raise common.McpmError(f'Invalid size {value}, expected something like 500M or 2G.')
+
+
+class DownloadProgress:
+    INTERVAL = 0.5
+
+    def __init__(self, total, stream=None):
+        self._total = total
+        self._stream = stream if stream is not None else sys.stderr
+        self._live = self._stream.isatty()
+        self._lock = threading.Lock()
+        self._done = 0
+        self._bytes = 0
+        self._start = time.monotonic()
+        self._last_report = 0
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self._start
+        return self._bytes / elapsed if elapsed > 0 else 0
+
+    def _status(self):
+        return f'[{self._done}/{self._total}] {format_size(self._bytes)} ({format_size(self.rate)}/s)'
+
+    def add_bytes(self, n):
+        with self._lock:
+            self._bytes += n
+            now = time.monotonic()
+            if self._live and now - self._last_report >= self.INTERVAL:
+                self._last_report = now
+                self._stream.write('\r' + self._status())
+                self._stream.flush()
+
+    def finish(self, download, status=None, error=None):
+        with self._lock:
+            self._done += 1
+            result = status if error is None else 'FAILED'
+            line = f'{self._status()} {download.filename} {result}'
+            self._stream.write(('\r' if self._live else '') + line + '\n')
+            self._stream.flush()
+
+
+class DownloadScheduler:
+
+    def __init__(self, workers, host_workers=DEFAULT_HOST_WORKERS, progress=None,
+                 store=None, verify=False, bundle=None):
+        self._workers = max(1, workers)
+        self._host_workers = max(1, host_workers)
+        self._progress = progress
+        self._store = store
+        self._verify = verify
+        self._bundle = bundle
+        self._hosts = {}
+
+    def _host_semaphore(self, download):
+        host = urllib.parse.urlsplit(download.url).hostname
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self._host_workers)
+        return self._hosts[host]
+
+    async def _fetch(self, download, dir, state, semaphore):
+        status = None
+        error = None
+        try:
+            # take the host slot first so waiting on a busy host never holds a global slot
+            async with self._host_semaphore(download), semaphore:
+                status = await common.to_thread(
+                        _fetch_file, download, dir, self._progress,
+                        self._store, state, self._verify, self._bundle
+                    )
+        except Exception as e:
+            error = e
+        if self._progress is not None:
+            self._progress.finish(download, status, error)
+        if error is not None:
+            raise error
+        return status
+
+    async def arun(self, jobs, return_exceptions=False):
+        # jobs are (DownloadRecord, directory, Manifest or None) triples
+        # largest first, unknown sizes (usually the server jar) before everything else;
+        # asyncio semaphores wake waiters in order, so creation order is start order
+        jobs = sorted(
+                jobs,
+                key=lambda job: -job[0].size if job[0].size is not None else float('-inf')
+            )
+        semaphore = asyncio.Semaphore(self._workers)
+        statuses = await asyncio.gather(
+                *(self._fetch(download, dir, state, semaphore) for download, dir, state in jobs),
+                return_exceptions=True
+            )
+        results = {}
+        errors = []
+        for (download, dir, state), status in zip(jobs, statuses):
+            results[dir / download.filename] = status
+            if isinstance(status, Exception):
+                errors.append((download.filename, status))
+        if errors and not return_exceptions:
+            raise common.DownloadError(errors)
+        return results
+
+
+async def adownload_packages(jobs, workers, host_workers=DEFAULT_HOST_WORKERS, progress=True,
+                             store=None, manifest=None, verify=False, bundle=None):
+    jobs = [
+        (download, dir, manifest)
+        for pkg_lock, dir in jobs for download in pkg_lock.downloads
+    ]
+    reporter = DownloadProgress(len(jobs)) if progress else None
+    scheduler = DownloadScheduler(workers, host_workers, reporter, store, verify, bundle)
+    return await scheduler.arun(jobs)
+
+
+def download_packages(jobs, workers, host_workers=DEFAULT_HOST_WORKERS, progress=True,
+                      store=None, manifest=None, verify=False, bundle=None):
+    coro = adownload_packages(jobs, workers, host_workers, progress, store, manifest, verify, bundle)
+    return common.run(coro, workers)
+
+
+def prune(state, keep, mode='remove'):
+    # files an earlier provision placed (they are in the manifest) that the lock
+    # no longer lists; anything changed since then isn't ours any more and stays
+    pruned = {}
+    if mode == 'keep':
+        return pruned
+    quarantine = state.root_dir / common.STATE_DIR / QUARANTINE_DIR / time.strftime('%Y%m%d-%H%M%S')
+    for key, entry in list(state.files.items()):
+        path = state.root_dir / key
+        if path in keep:
+            continue
+        if state.is_verified(path, entry['checksums']):
+            if mode == 'quarantine':
+                dest = quarantine / key
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(path, dest)
+            else:
+                path.unlink()
+            pruned[path] = 'removed' if mode == 'remove' else 'quarantined'
+        state.forget(path)
+    return pruned
+
+
+def is_staged_link(path, root_dir):
+    # what a staged provision places: a symlink through .mcpm/current
+    if not path.is_symlink():
+        return False
+    target = os.path.normpath(os.path.join(path.parent, os.readlink(path)))
+    return target.startswith(str(root_dir / common.STATE_DIR / common.CURRENT_LINK) + os.sep)
+
+
+def unstage(root_dir, keep):
+    # a plain provision takes over from a staged one: the links to jars it
+    # keeps become regular files (hardlinks into the live generation), the
+    # others are removed, and no generation is live any more
+    results = {}
+    for dir in (root_dir, root_dir / 'plugins'):
+        for path in dir.iterdir() if dir.is_dir() else ():
+            if not is_staged_link(path, root_dir):
+                continue
+            if path in keep and path.exists():
+                tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+                tmp.unlink(missing_ok=True)
+                try:
+                    os.link(path.resolve(), tmp)
+                except OSError:
+                    shutil.copyfile(path, tmp)
+                os.replace(tmp, path)
+            else:
+                path.unlink()
+                results[path] = 'unlinked'
+    (root_dir / common.STATE_DIR / common.CURRENT_LINK).unlink(missing_ok=True)
+    return results
+
+
+def job_paths(jobs):
+    return { dir / download.filename for pkg_lock, dir in jobs for download in pkg_lock.downloads }
+
+
+def provision_jobs(lock, dir):
+    (dir / 'plugins').mkdir(exist_ok=True)
+    jobs = [ (lock.server, dir) ]
+    jobs += [ (plugin, dir / 'plugins') for plugin in lock.plugins ]
+    return jobs
+
+
+async def aprovision(cfg, lock, dir=None, workers=None, host_workers=DEFAULT_HOST_WORKERS,
+                     store=None, verify=False, bundle=None, stale='remove'):
     if dir is None:
         dir = cfg.root_dir
-    download_package(lock.server, dir)
-    (dir / 'plugins').mkdir(exist_ok=True)
-    for plugin in lock.plugins:
-        download_package(plugin, dir / 'plugins')
\ No newline at end of file
+    if workers is None:
+        workers = common.DEFAULT_WORKERS
+    jobs = provision_jobs(lock, dir)
+    unstaged = unstage(dir, job_paths(jobs))
+    state = manifest.get_manifest(dir)
+    try:
+        results = await adownload_packages(
+                jobs, workers, host_workers,
+                store=store, manifest=state, verify=verify, bundle=bundle
+            )
+        results.update(prune(state, set(results), stale))
+        results.update(unstaged)
+        return results
+    finally:
+        manifest.write_manifest(state)
+
+
+def provision(cfg, lock, dir=None, workers=None, host_workers=DEFAULT_HOST_WORKERS,
+              store=None, verify=False, bundle=None, stale='remove'):
+    coro = aprovision(cfg, lock, dir, workers, host_workers, store, verify, bundle, stale)
+    return common.run(coro, workers)
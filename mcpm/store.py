@@ -0,0 +1,177 @@
+import errno
+import os
+import shutil
+import stat
+import threading
+import time
+import mcpm.common as common
+import mcpm.trace as trace
+
+try:
+    import fcntl
+except ImportError: # not available on windows
+    fcntl = None
+
+
+ALGORITHMS = [ 'sha512', 'sha256', 'sha1' ] # strongest first
+LINK_MODES = common.LINK_MODES
+FICLONE = 0x40049409
+
+
+def lock_file(f):
+    # blocks until no other mcpm process holds f, a no-op where flock is missing
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def move_into_place(tmp, dest, readonly=False):
+    if readonly:
+        os.chmod(tmp, 0o444) # linked copies share the inode, keep them read-only
+    os.replace(tmp, dest)
+
+
+def _reflink(src, dest):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported on this platform')
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+
+
+def _copy(src, dest):
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(src, dest)
+        return
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                n = os.copy_file_range(fsrc.fileno(), fdest.fileno(), remaining)
+                if n == 0:
+                    break
+                remaining -= n
+        except OSError:
+            remaining = -1
+    if remaining != 0:
+        shutil.copyfile(src, dest)
+
+
+class ArtifactStore:
+
+    def __init__(self, dir, link_mode='auto', offline=False):
+        if link_mode not in LINK_MODES:
+            raise common.McpmError(f'Unknown link mode {link_mode}.')
+        self._dir = dir
+        self._link_mode = link_mode
+        self._offline = offline
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @property
+    def dir(self):
+        return self._dir
+
+    @property
+    def offline(self):
+        return self._offline
+
+    @staticmethod
+    def key(checksums):
+        digests = { algo.lower(): digest.lower() for algo, digest in checksums.items() }
+        for algo in ALGORITHMS:
+            if algo in digests:
+                return algo, digests[algo]
+        return None
+
+    def path(self, checksums):
+        algo, digest = self.key(checksums)
+        return self._dir / algo / digest[:2] / digest
+
+    def has(self, checksums):
+        return self.key(checksums) is not None and self.path(checksums).is_file()
+
+    def discard(self, checksums):
+        self.path(checksums).unlink(missing_ok=True)
+
+    def lock(self, checksums):
+        with self._lock:
+            return self._key_locks.setdefault(self.key(checksums), threading.Lock())
+
+    def _link_strategies(self):
+        strategies = {
+            'auto': [ os.link, _reflink, _copy ],
+            'hardlink': [ os.link, _copy ],
+            'reflink': [ _reflink, _copy ],
+            'copy': [ _copy ],
+        }
+        return strategies[self._link_mode]
+
+    def evict(self, max_size=None, max_age=None):
+        # least recently used first; objects still hardlinked into a workspace are
+        # in use and always kept, interrupted downloads only go once they are old
+        now = time.time()
+        entries = []
+        total = 0
+        removed = 0
+        freed = 0
+        for path in self._dir.glob('*/*/*'):
+            try:
+                st = path.lstat()
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if path.name.endswith(('.part', '.part.json')):
+                if max_age is not None and now - st.st_mtime > max_age:
+                    path.unlink(missing_ok=True)
+                    removed += 1
+                    freed += st.st_size
+                continue
+            total += st.st_size
+            if st.st_nlink == 1:
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+        entries.sort()
+        for used, size, path in entries:
+            if (max_size is None or total <= max_size) and (max_age is None or now - used <= max_age):
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+            total -= size
+        return removed, freed
+
+    def place(self, checksums, dest):
+        src = self.path(checksums)
+        tmp = dest.with_name(f'.{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        strategies = self._link_strategies()
+        with trace.span(dest.name, 'place') as span:
+            for strategy in strategies[:-1]:
+                try:
+                    strategy(src, tmp)
+                    break
+                except OSError:
+                    tmp.unlink(missing_ok=True)
+            else:
+                strategy = strategies[-1]
+                strategy(src, tmp)
+            span.set(mode=strategy.__name__.lstrip('_'))
+            os.replace(tmp, dest)
+
+
+_store = None
+_settings = {}
+
+
+def configure(**kwargs):
+    global _store
+    _settings.update(kwargs)
+    _store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = ArtifactStore(common.get_cache_dir() / 'store', **_settings)
+    return _store
@@ -0,0 +1,184 @@
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+
+# Spans are timed operations with free-form args. Synchronous spans (http,
+# hashing, file I/O) nest per thread; async spans (one per plugin being
+# resolved or fetched) overlap freely on the event loop and are exported as
+# chrome async events. Tracing is off unless enable() was called, in which
+# case span() hands out a shared no-op span.
+
+SUMMARY_ROWS = 10
+
+
+class Span:
+
+    def __init__(self, tracer, name, cat, args, is_async):
+        self._tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.is_async = is_async
+        self.tid = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def add(self, key, n):
+        self.args[key] = self.args.get(key, 0) + n
+
+    def finish(self, error=None):
+        if self.end is not None:
+            return
+        self.end = time.perf_counter()
+        if error is not None:
+            self.args['error'] = type(error).__name__
+        self._tracer.record(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+
+
+class _NullSpan:
+
+    def set(self, **args):
+        pass
+
+    def add(self, key, n):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def _host(url):
+    return urllib.parse.urlsplit(url).netloc
+
+
+class Tracer:
+
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    @property
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def span(self, name, cat, is_async=False, **args):
+        return Span(self, name, cat, args, is_async)
+
+    def record(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        ids = itertools.count(1)
+        events = []
+        for span in self.spans:
+            ts = (span.start - self._origin) * 1e6
+            event = { 'name': span.name, 'cat': span.cat, 'pid': pid, 'tid': span.tid, 'args': span.args }
+            if span.is_async:
+                id = next(ids)
+                events.append({ **event, 'ph': 'b', 'id': id, 'ts': ts })
+                events.append({ **event, 'ph': 'e', 'id': id, 'ts': ts + span.duration * 1e6 })
+            else:
+                events.append({ **event, 'ph': 'X', 'ts': ts, 'dur': span.duration * 1e6 })
+        return { 'traceEvents': events, 'displayTimeUnit': 'ms' }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def print_summary(self, stream=None):
+        if stream is None:
+            stream = sys.stderr
+        spans = self.spans
+        by_cat = collections.defaultdict(list)
+        for span in spans:
+            by_cat[span.cat].append(span)
+
+        slowest = sorted(by_cat['batch'] + by_cat['resolve'] + by_cat['fetch'], key=lambda span: -span.duration)
+        if slowest:
+            stream.write(f"{'slowest':<40} {'step':<8} {'time':>9}\n")
+            for span in slowest[:SUMMARY_ROWS]:
+                stream.write(f'{span.name[:40]:<40} {span.cat:<8} {span.duration * 1000:>7.0f}ms\n')
+            stream.write('\n')
+
+        hosts = collections.defaultdict(collections.Counter)
+        for span in by_cat['http']:
+            host = hosts[_host(span.args.get('url', ''))]
+            host['requests'] += 1
+            host['time'] += span.duration
+            host['bytes'] += span.args.get('bytes', 0)
+            host['retries'] += span.args.get('retries', 0)
+            host['errors'] += 'error' in span.args or span.args.get('status', 0) >= 400
+        if hosts:
+            stream.write(f"{'host':<32} {'requests':>8} {'time':>9} {'bytes':>12} {'retries':>7} {'errors':>6}\n")
+            for name, host in sorted(hosts.items(), key=lambda item: -item[1]['time']):
+                stream.write(
+                    f"{name[:32]:<32} {host['requests']:>8} {host['time']:>8.2f}s {host['bytes']:>12}"
+                    f" {host['retries']:>7} {host['errors']:>6}\n"
+                )
+            stream.write('\n')
+
+        lookups = collections.Counter(span.args.get('result', 'failed') for span in by_cat['cache'])
+        if lookups:
+            stream.write('cache: ' + ', '.join(f'{n} {result}' for result, n in sorted(lookups.items())) + '\n')
+        hashed = by_cat['hash']
+        if hashed:
+            size = sum(span.args.get('bytes', 0) for span in hashed)
+            seconds = sum(span.duration for span in hashed)
+            stream.write(f'hashing: {len(hashed)} file(s), {size} bytes in {seconds:.2f}s\n')
+
+
+_tracer = None
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, cat, **args):
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, cat, **args)
+
+
+def async_span(name, cat, **args):
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, cat, is_async=True, **args)